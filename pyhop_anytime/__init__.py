@@ -2,6 +2,10 @@ from pyhop_anytime.pyhop import *
 from pyhop_anytime.oset import *
 from pyhop_anytime.auxiliary import *
 from pyhop_anytime.search_queues import *
+from pyhop_anytime.persistent import *
+from pyhop_anytime.cow import cow_copy
 from pyhop_anytime.grid import *
 from pyhop_anytime.graph import *
 from pyhop_anytime.stats import *
+from pyhop_anytime.trace import *
+from pyhop_anytime.profiling import *
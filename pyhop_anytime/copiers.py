@@ -0,0 +1,133 @@
+import copy
+from typing import *
+
+from pyhop_anytime.cow import CowView, cow_copy
+from pyhop_anytime.trail import Trail, TrailState, SET_ATTR
+
+
+def copy_to_depth(value, depth: int):
+    """Copies the nested dict/list/set containers of value down to the given depth, sharing everything below."""
+    if depth == 0:
+        return value
+    value_type = type(value)
+    if value_type is dict:
+        return {key: copy_to_depth(item, depth - 1) for key, item in value.items()}
+    elif value_type is list:
+        return [copy_to_depth(item, depth - 1) for item in value]
+    elif value_type is set:
+        return value.copy()
+    else:
+        return copy.deepcopy(value)
+
+
+def unshared(value):
+    return value.target if isinstance(value, CowView) else value
+
+
+def make_specialized_copier(copy_depths: Dict[str, int], attribute_types: Dict[str, type]) -> Callable:
+    """
+    Generates a copier that copies each attribute in copy_depths down to its depth. Every other attribute is shared
+    with the original state, its dicts, lists and sets through copy-on-write views as in cow_copy(), so that an
+    operator modifying an attribute it was not expected to modify copies that attribute rather than corrupting
+    the original state.
+    """
+    lines = ["def specialized_copier(state):",
+             "    result = cow_copy(state)",
+             "    values = result.__dict__",
+             "    originals = state.__dict__"]
+    for name, depth in sorted(copy_depths.items()):
+        if depth == 1 and attribute_types.get(name) in (dict, list, set):
+            lines.append(f"    values[{name!r}] = unshared(originals[{name!r}]).copy()")
+        else:
+            lines.append(f"    values[{name!r}] = copy_to_depth(unshared(originals[{name!r}]), {depth})")
+    lines.append("    return result")
+    namespace = {'copy_to_depth': copy_to_depth, 'cow_copy': cow_copy, 'unshared': unshared}
+    exec('\n'.join(lines), namespace)
+    return namespace['specialized_copier']
+
+
+def required_depths(changes: List[Tuple]) -> Dict[str, int]:
+    """
+    Given trail entries, returns for each modified attribute the depth to which it must be copied so that the
+    modification does not reach the original state. Rebinding an attribute requires no copying at all.
+    """
+    depths = {}
+    for kind, target, key, old, path in changes:
+        depth = 0 if kind == SET_ATTR else len(path)
+        depths[path[0]] = max(depth, depths.get(path[0], 0))
+    return depths
+
+
+def apply_recorded(operator, state, args) -> Tuple[Any, Trail]:
+    trail = Trail()
+    live_state = TrailState(state, trail)
+    result = operator(live_state, *args)
+    if result is live_state:
+        result = state
+    return result, trail
+
+
+class WriteRecorder:
+    """
+    Applies an operator to a fallback copy of the state through a TrailState, remembering which attributes it
+    modified, how deeply, and what types they held.
+    """
+    def __init__(self, fallback: Callable):
+        self.fallback = fallback
+        self.calls = 0
+        self.copy_depths = {}
+        self.attribute_types = {}
+
+    def apply(self, operator, state, args):
+        self.calls += 1
+        result, trail = apply_recorded(operator, self.fallback(state), args)
+        for name, depth in required_depths(trail.entries).items():
+            self.copy_depths[name] = max(depth, self.copy_depths.get(name, 0))
+            self.attribute_types[name] = type(getattr(state, name, None))
+        return result
+
+    def specialized(self, verify_calls: int) -> 'SpecializedCopier':
+        return SpecializedCopier({name: depth for (name, depth) in self.copy_depths.items() if depth > 0},
+                                 self.attribute_types, self.fallback, verify_calls)
+
+
+class SpecializedCopier:
+    """
+    Copies states for one operator using a generated copier. The first verify_calls applications run through a
+    TrailState; if one of them modifies something the generated copier does not copy, the modification is undone
+    and this operator uses the fallback copier from then on.
+
+    After verification, modifications of attributes that the copier does not copy at all still leave the original
+    state intact, since those attributes are shared copy-on-write. Modifications below the learned depth of a
+    copied attribute, however, are only detected during verification. Operators whose write depths vary with
+    their arguments need a verify_calls large enough to observe every case.
+    """
+    def __init__(self, copy_depths: Dict[str, int], attribute_types: Dict[str, type], fallback: Callable,
+                 verify_calls: int):
+        self.copy_depths = copy_depths
+        self.copier = make_specialized_copier(copy_depths, attribute_types)
+        self.fallback = fallback
+        self.verify_calls = verify_calls
+        self.covered = True
+
+    def __call__(self, state):
+        return self.copier(state) if self.covered else self.fallback(state)
+
+    def apply(self, operator, state, args):
+        if not self.covered:
+            return operator(self.fallback(state), *args)
+        elif self.verify_calls <= 0:
+            return operator(self.copier(state), *args)
+
+        self.verify_calls -= 1
+        copied = self.copier(state)
+        shared = [name for (name, value) in copied.__dict__.items() if isinstance(value, CowView)]
+        result, trail = apply_recorded(operator, copied, args)
+        depths = required_depths(trail.entries)
+        # Modifying a shared attribute gives the copy its own version of it without passing through the trail.
+        if any(depth > self.copy_depths.get(name, 0) for (name, depth) in depths.items()) or \
+                any(name not in depths and not isinstance(copied.__dict__.get(name), CowView) for name in shared):
+            trail.undo_to(0)
+            self.covered = False
+            return operator(self.fallback(state), *args)
+        return result
@@ -0,0 +1,180 @@
+import copy
+from typing import *
+
+
+def copy_containers(value, copies=None):
+    """
+    Copies every dict, list and set nested within value. Any other objects are shared with the original. If copies
+    is given, it maps the id of each copied container to the pair of that container and its copy.
+    """
+    value_type = type(value)
+    if value_type is dict:
+        result = {key: copy_containers(item, copies) for key, item in value.items()}
+    elif value_type is list:
+        result = [copy_containers(item, copies) for item in value]
+    elif value_type is set:
+        result = value.copy()
+    else:
+        return value
+    if copies is not None:
+        copies[id(value)] = (value, result)
+    return result
+
+
+def cow_copy(state):
+    """
+    Copy-on-write copy of state, for use as a Planner copy_func. The copy shares every dict, list and set
+    attribute with the original through a CowView. The first modification of such an attribute replaces the view
+    in the copy with a private copy of that attribute alone. Scalar attributes and other objects are shared
+    outright, so operators must only modify the dicts, lists and sets of a state, or rebind its attributes.
+    """
+    result = object.__new__(type(state))
+    values = result.__dict__
+    static = state.static_names() if hasattr(state, 'static_names') else ()
+    for name, value in state.__dict__.items():
+        if name in static:
+            values[name] = value
+        elif isinstance(value, CowView):
+            values[name] = type(value)(value.target, result, name)
+        else:
+            view_type = COW_VIEW_TYPES.get(type(value))
+            values[name] = value if view_type is None else view_type(value, result, name)
+    return result
+
+
+class CowView:
+    """
+    Read-only window onto a container shared with another state. Mutating methods first copy the whole attribute
+    the view belongs to, then apply the mutation to that copy. From then on, every view of that attribute reads
+    the copy, so an operator may keep using a view it obtained before writing through it. The copy replaces the
+    attribute in the owning state unless the operator has meanwhile rebound that attribute, in which case only
+    the views see the copy, just as they would still see the original container had the state been deep-copied.
+    """
+    __slots__ = ['shared', 'owner', 'name', 'root', 'copies']
+    __hash__ = None
+
+    def __init__(self, target, owner, name: str, root=None):
+        self.shared = target
+        self.owner = owner
+        self.name = name
+        # The view of the whole attribute. Once it has been materialized, its copies map the id of each shared
+        # container within the attribute to that container and its private copy.
+        self.root = self if root is None else root
+        self.copies = None
+
+    @property
+    def target(self):
+        copies = self.root.copies
+        if copies is not None:
+            entry = copies.get(id(self.shared))
+            if entry is not None and entry[0] is self.shared:
+                return entry[1]
+        return self.shared
+
+    def materialize(self):
+        root = self.root
+        if root.copies is None:
+            root.copies = {}
+            private = copy_containers(root.shared, root.copies)
+            values = root.owner.__dict__
+            if values.get(root.name) is root:
+                values[root.name] = private
+        return self.target
+
+    def __getattr__(self, name):
+        if name in CowView.__slots__ or name == 'target':
+            raise AttributeError(name)
+        return getattr(self.target, name)
+
+    def __getitem__(self, key):
+        if type(key) is slice:
+            return [self[i] for i in range(*key.indices(len(self.target)))]
+        item = self.target[key]
+        view_type = COW_VIEW_TYPES.get(type(item))
+        if view_type is None:
+            return item
+        return view_type(item, self.owner, self.name, self.root)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.target else default
+
+    def __len__(self):
+        return len(self.target)
+
+    def __bool__(self):
+        return len(self.target) > 0
+
+    def __iter__(self):
+        return iter(self.target)
+
+    def __contains__(self, item):
+        return item in self.target
+
+    def __eq__(self, other):
+        return self.target == (other.target if isinstance(other, CowView) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.target)
+
+    def __copy__(self):
+        return self.target.copy()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.target, memo)
+
+    def __reduce__(self):
+        return copy_containers, (self.target,)
+
+
+def read_only(name):
+    return lambda self, *args: getattr(self.target, name)(*(arg.target if isinstance(arg, CowView) else arg
+                                                             for arg in args))
+
+
+def copy_on_write(name):
+    return lambda self, *args, **kwargs: getattr(self.materialize(), name)(*args, **kwargs)
+
+
+def make_view_type(class_name: str, reads: List[str], writes: List[str]) -> type:
+    members = {'__slots__': []}
+    members.update({name: read_only(name) for name in reads})
+    members.update({name: copy_on_write(name) for name in writes})
+    return type(class_name, (CowView,), members)
+
+
+CowDict = make_view_type('CowDict', ['__or__'],
+                         ['__setitem__', '__delitem__', 'pop', 'popitem', 'setdefault', 'update', 'clear', '__ior__'])
+CowList = make_view_type('CowList', ['__add__', '__mul__', '__lt__', '__le__', '__gt__', '__ge__'],
+                         ['__setitem__', '__delitem__', 'append', 'extend', 'insert', 'pop', 'remove', 'sort',
+                          'reverse', 'clear', '__iadd__', '__imul__'])
+CowSet = make_view_type('CowSet', ['__or__', '__and__', '__sub__', '__xor__', '__lt__', '__le__', '__gt__', '__ge__'],
+                        ['add', 'discard', 'remove', 'pop', 'update', 'clear', 'difference_update',
+                         'intersection_update', 'symmetric_difference_update', '__ior__', '__iand__', '__isub__',
+                         '__ixor__'])
+
+COW_VIEW_TYPES = {dict: CowDict, list: CowList, set: CowSet}
+
+
+def cow_items(self):
+    return [(key, self[key]) for key in self.target]
+
+
+def cow_values(self):
+    return [self[key] for key in self.target]
+
+
+def cow_list_iter(self):
+    return (self[i] for i in range(len(self.target)))
+
+
+def cow_list_reversed(self):
+    return (self[i] for i in reversed(range(len(self.target))))
+
+
+CowDict.items = cow_items
+CowDict.values = cow_values
+CowList.__iter__ = cow_list_iter
+CowList.__reversed__ = cow_list_reversed
@@ -0,0 +1,118 @@
+from typing import *
+
+from pyhop_anytime.cow import CowView
+from pyhop_anytime.trail import TrailView, SET_ATTR, SET_ITEM, SET_ADD, SET_DISCARD
+
+
+def freeze(value) -> Hashable:
+    """Converts value into an equivalent hashable value, recursively replacing dicts, lists and sets."""
+    value_type = type(value)
+    if value_type is dict:
+        return frozenset((key, freeze(item)) for key, item in value.items())
+    elif value_type is list or value_type is tuple:
+        return tuple(freeze(item) for item in value)
+    elif value_type is set:
+        return frozenset(value)
+    elif isinstance(value, (CowView, TrailView)):
+        return freeze(value.target)
+    elif value_type.__hash__ is None:
+        return id(value)
+    else:
+        return value
+
+
+# Zobrist-style fingerprints: a state's fingerprint is the XOR of the mixed hashes of its parts. Each dict item
+# and set element of an attribute is a separate part, and every other attribute value is a single part. A
+# successor's fingerprint can then be derived from its parent's by XORing out the old versions of the parts an
+# operator changed and XORing in their new versions. Fingerprints are stable within a process.
+
+MASK = (1 << 64) - 1
+UNTRACKED = frozenset(['__name__', '__static__'])
+
+
+def mix(value: Hashable) -> int:
+    """SplitMix64 finalizer applied to hash(value), so that XORed part hashes do not cancel systematically."""
+    z = (hash(value) + 0x9E3779B97F4A7C15) & MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK
+    return z ^ (z >> 31)
+
+
+def contents(value):
+    while isinstance(value, (CowView, TrailView)):
+        value = value.target
+    return value
+
+
+def attribute_fingerprint(name: str, value) -> int:
+    value = contents(value)
+    value_type = type(value)
+    if value_type is dict:
+        result = mix((name, dict))
+        for key, item in value.items():
+            result ^= mix((name, key, freeze(item)))
+        return result
+    elif value_type is set:
+        result = mix((name, set))
+        for item in value:
+            result ^= mix((name, item))
+        return result
+    else:
+        return mix((name, freeze(value)))
+
+
+def part_fingerprint(name: str, container, key) -> int:
+    container = contents(container)
+    if type(container) is dict:
+        return mix((name, key, freeze(container[key]))) if key in container else 0
+    else:
+        return mix((name, key)) if key in container else 0
+
+
+def state_fingerprint(state, ignore: FrozenSet[str] = frozenset()) -> int:
+    """
+    Fingerprint of the contents of every attribute of state whose name is not in ignore. Static attributes never
+    change during planning, so they can be ignored.
+    """
+    result = 0
+    for name, value in vars(state).items():
+        if name not in ignore and name not in UNTRACKED:
+            result ^= attribute_fingerprint(name, value)
+    return result
+
+
+def updated_fingerprint(old_state, new_state, old_fingerprint: int, changes: List[Tuple],
+                        ignore: FrozenSet[str] = frozenset()) -> int:
+    """
+    Fingerprint of new_state, given that old_fingerprint is the fingerprint of old_state and that changes, a list
+    of Trail entries, records every modification that turned a copy of old_state into new_state. The cost is
+    proportional to the number of changed parts rather than to the size of the state.
+    """
+    changed_attributes = set()
+    changed_parts = set()
+    for kind, target, key, old, path in changes:
+        name = path[0]
+        if name in ignore or name in UNTRACKED:
+            continue
+        old_value = contents(getattr(old_state, name, None))
+        if kind == SET_ATTR or type(old_value) not in (dict, set):
+            changed_attributes.add(name)
+        elif len(path) > 1:
+            changed_parts.add((name, path[1]))
+        elif kind in (SET_ITEM, SET_ADD, SET_DISCARD):
+            changed_parts.add((name, key))
+        else:
+            changed_attributes.add(name)
+
+    result = old_fingerprint
+    for name in changed_attributes:
+        if hasattr(old_state, name):
+            result ^= attribute_fingerprint(name, getattr(old_state, name))
+        if hasattr(new_state, name):
+            result ^= attribute_fingerprint(name, getattr(new_state, name))
+    for name, key in changed_parts:
+        if name not in changed_attributes:
+            result ^= part_fingerprint(name, getattr(old_state, name), key)
+            result ^= part_fingerprint(name, getattr(new_state, name), key)
+    return result
+
@@ -114,6 +114,22 @@ class Graph:
                     if successor not in visited:
                         heapq.heappush(edges, (distance, dest, successor))
 
+    def spanning_tree_cost(self, nodes: Iterable[Hashable]) -> float:
+        """Cost of a minimum spanning tree of the subgraph induced by nodes, found with Prim's algorithm."""
+        remaining = set(nodes)
+        if len(remaining) < 2:
+            return 0
+        start = remaining.pop()
+        closest = {node: self.edges[start].get(node, math.inf) for node in remaining}
+        total = 0
+        while closest:
+            node = min(closest, key=closest.get)
+            total += closest.pop(node)
+            for other, distance in self.edges[node].items():
+                if other in closest and distance < closest[other]:
+                    closest[other] = distance
+        return total
+
     def mst_ready(self) -> bool:
         return self.num_nodes() == len(self.mst)
 
@@ -0,0 +1,342 @@
+import math
+import multiprocessing
+import os
+import random
+import time
+import traceback
+from collections import deque
+from queue import Empty
+from typing import *
+
+from pyhop_anytime.search_queues import mean_rollout_cost
+
+
+def process_context():
+    """
+    Planners usually hold lambdas, which cannot be pickled, so workers are forked wherever the platform allows it.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    else:
+        return multiprocessing.get_context()
+
+
+class SharedIncumbent:
+    """
+    Cost of the best plan found so far by any of a group of worker processes, kept in shared memory.
+    """
+    def __init__(self, context=None):
+        context = process_context() if context is None else context
+        self.cost = context.Value('d', math.inf)
+
+    def get(self) -> Optional[float]:
+        cost = self.cost.value
+        return None if cost == math.inf else cost
+
+    def bound(self, local_cost: Optional[float]) -> Optional[float]:
+        shared_cost = self.get()
+        if local_cost is None or (shared_cost is not None and shared_cost < local_cost):
+            return shared_cost
+        return local_cost
+
+    def offer(self, cost: float) -> bool:
+        with self.cost.get_lock():
+            if cost < self.cost.value:
+                self.cost.value = cost
+                return True
+            return False
+
+
+def worker_seeds(num_workers: int, seed: Optional[int]) -> List[int]:
+    generator = random.Random(seed)
+    return [generator.getrandbits(64) for i in range(num_workers)]
+
+
+def merge_plan_times(traces: Iterable[List[Tuple]]) -> List[Tuple]:
+    """
+    Merges anytime traces from several workers into a single trace ordered by time, keeping only the entries
+    that improve on every entry before them.
+    """
+    merged = sorted((entry for trace in traces for entry in trace), key=lambda entry: entry[2])
+    result = []
+    for entry in merged:
+        if len(result) == 0 or entry[1] < result[-1][1]:
+            result.append(entry)
+    return result
+
+
+def run_worker(index, planner, method_name, args, kwargs, seed, incumbent, start_time, results):
+    try:
+        random.seed(seed)
+        planner.incumbent = incumbent
+        offset = time.time() - start_time
+        plan_times = getattr(planner, method_name)(*args, **kwargs)
+        results.put((index, [(plan, cost, elapsed + offset) for (plan, cost, elapsed) in plan_times],
+                     planner.node_expansions, None))
+    except Exception:
+        results.put((index, [], planner.node_expansions, traceback.format_exc()))
+
+
+# Seconds between checks that the workers whose results are outstanding are still running.
+RESULT_POLL_SECONDS = 0.5
+
+
+def gather_results(results, workers) -> List[Tuple]:
+    """
+    Collects one (worker index, ...) result from each of workers. Raises RuntimeError, after terminating the
+    other workers, if a worker exits without posting its result, as when it is killed by a signal.
+    """
+    gathered = {}
+    silent = set()
+    while len(gathered) < len(workers):
+        try:
+            result = results.get(timeout=RESULT_POLL_SECONDS)
+            gathered[result[0]] = result
+        except Empty:
+            # A worker's result may still be in transit when it exits, so it gets one more poll.
+            exited = {i for (i, worker) in enumerate(workers) if i not in gathered and worker.exitcode is not None}
+            lost = exited & silent
+            if len(lost) > 0:
+                for worker in workers:
+                    if worker.is_alive():
+                        worker.terminate()
+                codes = ', '.join(f"worker {i} exit code {workers[i].exitcode}" for i in sorted(lost))
+                raise RuntimeError(f"{len(lost)} worker(s) exited without reporting a result: {codes}")
+            silent = exited
+    return [gathered[i] for i in range(len(workers))]
+
+
+def run_parallel(planner, jobs: List[Tuple[str, Tuple, Dict]], seed=None) -> Tuple[List[List[Tuple]], int]:
+    """
+    Runs each (method name, args, kwargs) job as planner.method(*args, **kwargs) in its own process, with its own
+    random seed and all of them sharing one SharedIncumbent. Every method must return an anytime trace of
+    (plan, cost, elapsed) entries. Returns the traces in the order of the jobs, with elapsed times measured from a
+    common start, and the total number of node expansions.
+    """
+    context = process_context()
+    incumbent = SharedIncumbent(context)
+    results = context.Queue()
+    start_time = time.time()
+    workers = [context.Process(target=run_worker, args=(i, planner, name, args, kwargs, worker_seed, incumbent,
+                                                        start_time, results), daemon=True)
+               for (i, ((name, args, kwargs), worker_seed)) in enumerate(zip(jobs, worker_seeds(len(jobs), seed)))]
+    for worker in workers:
+        worker.start()
+    traces = [None] * len(workers)
+    node_expansions = 0
+    errors = []
+    for index, trace, expansions, error in gather_results(results, workers):
+        traces[index] = trace
+        node_expansions += expansions
+        if error is not None:
+            errors.append(error)
+    for worker in workers:
+        worker.join()
+    if len(errors) > 0:
+        raise RuntimeError(f"{len(errors)} worker(s) failed. First failure:\n{errors[0]}")
+    return traces, node_expansions
+
+
+# Number of node expansions between a busy work-stealing worker's checks for steal requests.
+STEAL_CHECK_INTERVAL = 16
+
+
+class WorkStealingWorker:
+    """
+    One process of a parallel depth-first branch-and-bound search. It expands nodes from its own stack. Once its
+    stack is empty, it asks randomly chosen workers for work until one hands over the shallowest node of its stack.
+
+    The shared idle counter makes termination detection safe: a worker that hands over a node decrements it on the
+    recipient's behalf before sending, so idle reaches num_workers only when no node is on any stack or in transit.
+    """
+    def __init__(self, index, planner, num_workers, root, incumbent, idle, done, timed_out, requests, inboxes,
+                 deadline, start_time):
+        self.index = index
+        self.planner = planner
+        self.num_workers = num_workers
+        self.stack = deque()
+        if root is not None:
+            self.stack.append(planner.restore_step(root))
+        self.incumbent = incumbent
+        self.idle = idle
+        self.done = done
+        self.timed_out = timed_out
+        self.requests = requests
+        self.inboxes = inboxes
+        self.deadline = deadline
+        self.start_time = start_time
+        self.plan_times = []
+        self.awaiting_reply = False
+
+    def run(self):
+        lowest_cost = None
+        while not self.done.is_set():
+            if len(self.stack) > 0:
+                if self.planner.node_expansions % STEAL_CHECK_INTERVAL == 0:
+                    self.answer_requests()
+                    self.check_deadline()
+                candidate = self.stack.pop()
+                self.planner.node_expansions += 1
+                lowest_cost = self.incumbent.bound(lowest_cost)
+                if lowest_cost is None or self.planner.cost_bound(candidate) < lowest_cost:
+                    if candidate.complete():
+                        lowest_cost = candidate.total_cost
+                        if self.incumbent.offer(lowest_cost):
+                            self.plan_times.append((candidate.plan, lowest_cost, time.time() - self.start_time))
+                    else:
+                        self.stack.extend(candidate.successors(self.planner))
+                if len(self.stack) == 0:
+                    self.become_idle()
+            else:
+                self.seek_work()
+        return self.plan_times
+
+    def become_idle(self):
+        with self.idle.get_lock():
+            self.idle.value += 1
+            if self.idle.value == self.num_workers:
+                self.done.set()
+
+    def check_deadline(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            self.timed_out.value = True
+            self.done.set()
+
+    def answer_requests(self):
+        while True:
+            try:
+                requester = self.requests[self.index].get_nowait()
+            except Empty:
+                return
+            if len(self.stack) > 1:
+                with self.idle.get_lock():
+                    self.idle.value -= 1
+                self.inboxes[requester].put(self.planner.portable_step(self.stack.popleft()))
+            else:
+                self.inboxes[requester].put(None)
+
+    def seek_work(self):
+        self.answer_requests()
+        self.check_deadline()
+        if not self.awaiting_reply:
+            victim = random.choice([i for i in range(self.num_workers) if i != self.index])
+            self.requests[victim].put(self.index)
+            self.awaiting_reply = True
+        try:
+            reply = self.inboxes[self.index].get(timeout=0.001)
+        except Empty:
+            return
+        self.awaiting_reply = False
+        if reply is not None:
+            self.stack.append(self.planner.restore_step(reply))
+
+
+def run_stealing_worker(index, planner, num_workers, root, incumbent, idle, done, timed_out, requests, inboxes,
+                        deadline, start_time, results):
+    try:
+        planner.reset_node_expansions()
+        worker = WorkStealingWorker(index, planner, num_workers, root, incumbent, idle, done, timed_out, requests,
+                                    inboxes, deadline, start_time)
+        results.put((index, worker.run(), planner.node_expansions, None))
+    except Exception:
+        done.set()
+        results.put((index, [], planner.node_expansions, traceback.format_exc()))
+
+
+def run_work_stealing(planner, root, num_workers: int, max_seconds=None) -> Tuple[List[Tuple], int, bool]:
+    """
+    Parallel depth-first branch-and-bound search from the portable root step, using num_workers processes.
+    Returns the merged anytime trace, the total number of node expansions, and whether the search space was
+    exhausted before max_seconds elapsed.
+    """
+    context = process_context()
+    incumbent = SharedIncumbent(context)
+    idle = context.Value('i', num_workers - 1)
+    done = context.Event()
+    timed_out = context.Value('b', False)
+    requests = [context.Queue() for i in range(num_workers)]
+    inboxes = [context.Queue() for i in range(num_workers)]
+    results = context.Queue()
+    start_time = time.time()
+    deadline = None if max_seconds is None else start_time + max_seconds
+    workers = [context.Process(target=run_stealing_worker,
+                               args=(i, planner, num_workers, root if i == 0 else None, incumbent, idle, done,
+                                     timed_out, requests, inboxes, deadline, start_time, results), daemon=True)
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    traces = []
+    node_expansions = 0
+    errors = []
+    try:
+        gathered = gather_results(results, workers)
+    except RuntimeError:
+        done.set()
+        raise
+    for index, trace, expansions, error in gathered:
+        traces.append(trace)
+        node_expansions += expansions
+        if error is not None:
+            errors.append(error)
+    for worker in workers:
+        worker.join()
+    if len(errors) > 0:
+        raise RuntimeError(f"{len(errors)} worker(s) failed. First failure:\n{errors[0]}")
+    return merge_plan_times(traces), node_expansions, not timed_out.value
+
+
+# Planner of the current rollout worker process, installed by set_rollout_planner().
+rollout_planner = None
+
+
+def set_rollout_planner(planner):
+    global rollout_planner
+    rollout_planner = planner
+
+
+def rollout_rating(portable, num_samples, seed):
+    random.seed(seed)
+    return mean_rollout_cost(rollout_planner, rollout_planner.restore_step(portable), num_samples)
+
+
+class RolloutEvaluator:
+    """
+    Pool of worker processes that rate plan steps for a MonteCarloPlannerHeap, one step per task. Each step's
+    rollouts use their own random seed, drawn in order from a generator seeded with seed, so ratings do not
+    depend on which worker computes them. States must be picklable. Call close(), or use a with statement, to
+    stop the workers.
+    """
+    def __init__(self, planner, num_workers=None, seed=None):
+        num_workers = default_num_workers() if num_workers is None else num_workers
+        self.pool = process_context().Pool(num_workers, initializer=set_rollout_planner, initargs=(planner,))
+        self.planner = planner
+        self.seeds = random.Random(seed)
+
+    def ratings(self, plan_steps, num_samples: int) -> List[Optional[float]]:
+        jobs = [(self.planner.portable_step(step), num_samples, self.seeds.getrandbits(64)) for step in plan_steps]
+        return self.pool.starmap(rollout_rating, jobs)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+# Engines available to Planner.anyhop_portfolio(): name -> (Planner method, extra keyword arguments).
+PORTFOLIO_ENGINES = {
+    'dfs': ('anyhop', {}),
+    'trail': ('anyhop_trail', {}),
+    'random': ('anyhop_random', {}),
+    'tracked': ('anyhop_random_tracked', {'use_max_cost': True}),
+    'tracked_dfs_seed': ('anyhop_random_tracked_dfs_seed', {}),
+    'nrpa': ('anyhop_nrpa', {}),
+}
+
+
+def default_num_workers() -> int:
+    return os.cpu_count() or 1
@@ -0,0 +1,120 @@
+from typing import *
+
+from pyhop_anytime.fingerprint import freeze
+
+
+class ConsList:
+    """
+    Immutable singly-linked list. Pushing onto a ConsList creates a new list that shares every existing cell with
+    the original, so search nodes can extend their parent's list in O(1) time and memory.
+
+    PlanStep uses a ConsList as its task agenda: the head is the next task, and a method's subtasks are pushed
+    on top of the remaining tasks in O(len(subtasks)) time.
+    """
+    __slots__ = ['head', 'tail', 'length', 'hash_code']
+
+    def __init__(self, head=None, tail=None):
+        self.head = head
+        self.tail = tail
+        self.length = 0 if tail is None else tail.length + 1
+        self.hash_code = 0 if tail is None else None
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        current = self
+        while current.length > 0:
+            yield current.head
+            current = current.tail
+
+    def __repr__(self):
+        return f"ConsList({self.to_list()})"
+
+    @staticmethod
+    def from_list(items: Sequence) -> 'ConsList':
+        return EMPTY.push_all(items)
+
+    def push(self, item) -> 'ConsList':
+        return ConsList(item, self)
+
+    def push_all(self, items: Sequence) -> 'ConsList':
+        result = self
+        for i in range(len(items) - 1, -1, -1):
+            result = ConsList(items[i], result)
+        return result
+
+    def fingerprint(self) -> int:
+        """
+        Hash of the contents of this list. It is cached in every cell, so lists that share a tail only hash their
+        own cells. Items need not be hashable.
+        """
+        if self.hash_code is None:
+            unhashed = []
+            current = self
+            while current.hash_code is None:
+                unhashed.append(current)
+                current = current.tail
+            for cell in reversed(unhashed):
+                cell.hash_code = hash((freeze(cell.head), cell.tail.hash_code))
+        return self.hash_code
+
+    def to_list(self) -> List:
+        return list(self)
+
+    def to_reversed_list(self) -> List:
+        result = self.to_list()
+        result.reverse()
+        return result
+
+
+EMPTY = ConsList()
+
+
+class LinkedPlan:
+    """
+    A plan stored as a chain of steps linked back to its prefix. Children share the entire prefix with their parent,
+    and the plan is materialized as a Python list only on request.
+    """
+    __slots__ = ['steps']
+
+    def __init__(self, steps: ConsList = EMPTY):
+        self.steps = steps
+
+    @staticmethod
+    def from_list(plan: List) -> 'LinkedPlan':
+        steps = EMPTY
+        for step in plan:
+            steps = steps.push(step)
+        return LinkedPlan(steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return f"LinkedPlan({self.to_list()})"
+
+    def append(self, step) -> 'LinkedPlan':
+        return LinkedPlan(self.steps.push(step))
+
+    def extend(self, steps: Sequence) -> 'LinkedPlan':
+        result = self.steps
+        for step in steps:
+            result = result.push(step)
+        return LinkedPlan(result)
+
+    def since(self, length: int) -> List:
+        """The steps appended after the first length steps of this plan."""
+        result = []
+        current = self.steps
+        while len(current) > length:
+            result.append(current.head)
+            current = current.tail
+        result.reverse()
+        return result
+
+    def to_list(self) -> List:
+        return self.steps.to_reversed_list()
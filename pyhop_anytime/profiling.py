@@ -0,0 +1,92 @@
+import time
+from collections import Counter
+from functools import wraps
+from typing import *
+
+
+class SearchProfile:
+    """
+    Counters collected by Planner.profiled(). For each method and operator name, it records the number of calls,
+    their total wall time, how many failed and how many options they returned in total. A successful operator
+    returns one option. It also records the calls to the copy and cost functions and their total wall time, and
+    how many plan steps were expanded at each depth.
+
+    Operators that copy states with copiers learned by Planner.learn_copy_funcs() count that copying in their own
+    time rather than in copy_seconds.
+    """
+    def __init__(self):
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.failures = Counter()
+        self.options = Counter()
+        self.copy_calls = 0
+        self.copy_seconds = 0.0
+        self.cost_calls = 0
+        self.cost_seconds = 0.0
+        self.depths = Counter()
+
+    def failure_rate(self, name: str) -> float:
+        return self.failures[name] / self.calls[name] if self.calls[name] > 0 else 0.0
+
+    def branching_factor(self, name: str) -> float:
+        return self.options[name] / self.calls[name] if self.calls[name] > 0 else 0.0
+
+    def mean_seconds(self, name: str) -> float:
+        return self.seconds[name] / self.calls[name] if self.calls[name] > 0 else 0.0
+
+    def record(self, name: str, seconds: float, num_options: int):
+        self.calls[name] += 1
+        self.seconds[name] += seconds
+        self.options[name] += num_options
+        if num_options == 0:
+            self.failures[name] += 1
+
+    def timed_operator(self, name: str, operator: Callable) -> Callable:
+        @wraps(operator)
+        def timed(*args):
+            start = time.perf_counter()
+            result = operator(*args)
+            self.record(name, time.perf_counter() - start, 1 if result else 0)
+            return result
+        return timed
+
+    def timed_method(self, name: str, method: Callable) -> Callable:
+        @wraps(method)
+        def timed(*args):
+            start = time.perf_counter()
+            result = method(*args)
+            self.record(name, time.perf_counter() - start, 0 if result is None else len(result.options))
+            return result
+        return timed
+
+    def timed_copy(self, copy_func: Callable) -> Callable:
+        def timed(state):
+            start = time.perf_counter()
+            result = copy_func(state)
+            self.copy_seconds += time.perf_counter() - start
+            self.copy_calls += 1
+            return result
+        return timed
+
+    def timed_cost(self, cost_func: Callable) -> Callable:
+        def timed(state, step):
+            start = time.perf_counter()
+            result = cost_func(state, step)
+            self.cost_seconds += time.perf_counter() - start
+            self.cost_calls += 1
+            return result
+        return timed
+
+    def report(self) -> str:
+        lines = [f"{'name':>20} {'calls':>9} {'seconds':>9} {'failed':>7} {'branching':>9}"]
+        for name in sorted(self.calls, key=lambda name: -self.seconds[name]):
+            lines.append(f"{name:>20} {self.calls[name]:>9} {self.seconds[name]:>9.3f} "
+                         f"{self.failure_rate(name):>7.1%} {self.branching_factor(name):>9.2f}")
+        lines.append(f"{'copy_func':>20} {self.copy_calls:>9} {self.copy_seconds:>9.3f}")
+        lines.append(f"{'cost_func':>20} {self.cost_calls:>9} {self.cost_seconds:>9.3f}")
+        lines.append("expansions by depth: " + ", ".join(f"{depth}: {count}"
+                                                         for (depth, count) in sorted(self.depths.items())))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return self.report()
@@ -27,17 +27,47 @@ Copyright 2013 Dana S. Nau - http://www.cs.umd.edu/~nau
 """
 
 import copy
+import heapq
+import math
 import time
 from typing import *
 
 from pyhop_anytime.search_queues import *
+from pyhop_anytime.persistent import *
+from pyhop_anytime.trail import Trail, TrailState
+from pyhop_anytime.copiers import WriteRecorder
+from pyhop_anytime.cow import CowView
+from pyhop_anytime.fingerprint import freeze, state_fingerprint, updated_fingerprint
+from pyhop_anytime.trace import EXPAND, PRUNE, YIELD, FAIL
+from pyhop_anytime.profiling import SearchProfile
+from pyhop_anytime.parallel import run_parallel, run_work_stealing, merge_plan_times, default_num_workers, \
+    PORTFOLIO_ENGINES
 import random
 
 
 class Planner:
-    def __init__(self, verbose=0, copy_func=copy.deepcopy, cost_func=lambda state, step: 1):
-        self.copy_func = copy_func
+    def __init__(self, verbose=0, copy_func=None, cost_func=lambda state, step: 1, static_attributes=(),
+                 incremental_fingerprints=False, lower_bound=None, memo=None, subplan_cache=None,
+                 frontier_cache=None, tracer=None):
+        self.static_attributes = frozenset(static_attributes)
+        self.incremental_fingerprints = incremental_fingerprints
+        self.copy_func = copy_func if copy_func else lambda state: copy_state(state, self.static_attributes)
         self.cost_func = cost_func
+        # Optional function (state, tasks) -> admissible estimate of the cost of accomplishing tasks from state.
+        self.lower_bound = lower_bound
+        # Optional MemoCache of method and operator results, for domains whose methods and operators are pure.
+        self.memo = memo
+        # Optional SubplanCache. Once a task has a cached subplan from a state, that subplan is one more option.
+        self.subplan_cache = subplan_cache
+        # Optional MemoCache of recently derived states. If given, successors are DerivedPlanSteps, which keep no state.
+        self.frontier_cache = frontier_cache
+        # Optional sink, such as a JsonlTraceSink, for expand, prune, yield and fail events of the searches.
+        self.tracer = tracer
+        # The SearchProfile of the current run of profiled(), which counts expansions by depth.
+        self.profile = None
+        self.operator_copy_funcs = {}
+        # A SharedIncumbent, when this planner runs as one of several parallel workers.
+        self.incumbent = None
         self.operators = {}
         self.methods = {}
         self.verbose = verbose
@@ -52,12 +82,100 @@ class Planner:
     def declare_methods(self, *method_list):
         self.methods.update({method.__name__: method for method in method_list})
 
+    def declare_static_attributes(self, *names):
+        self.static_attributes = self.static_attributes.union(names)
+
     def add_operator(self, name: str, operator: Callable):
         self.operators[name] = operator
 
     def add_method(self, name: str, method: Callable):
         self.methods[name] = method
 
+    def apply_operator(self, operator, task, state, copy_func):
+        specialized = self.operator_copy_funcs.get(task[0])
+        if specialized is None:
+            return operator(copy_func(state), *task[1:])
+        else:
+            return specialized.apply(operator, state, task[1:])
+
+    def cost_bound(self, plan_step) -> float:
+        """
+        Lowest cost at which plan_step could be completed: its total cost plus the lower_bound estimate for its
+        remaining tasks. A plan_step whose cost bound is at least the cost of a known plan can be pruned.
+        """
+        if self.lower_bound is None or plan_step.complete():
+            return plan_step.total_cost
+        state = plan_step.state
+        if not state:
+            # A lazy or derived step whose operator failed. It has no successors, so it will be dropped anyway.
+            return plan_step.total_cost
+        return plan_step.total_cost + self.lower_bound(state, plan_step.tasks)
+
+    def static_names(self, state) -> FrozenSet[str]:
+        """Attributes declared static on the planner or on state itself, which fingerprints ignore."""
+        if isinstance(state, State):
+            return self.static_attributes.union(state.static_names())
+        return self.static_attributes
+
+    def state_hash(self, plan_step) -> int:
+        if plan_step.state_hash is None:
+            state = plan_step.state
+            plan_step.state_hash = state_fingerprint(state, self.static_names(state))
+        return plan_step.state_hash
+
+    def fingerprint(self, plan_step) -> Tuple[int, int]:
+        return self.state_hash(plan_step), plan_step.tasks.fingerprint()
+
+    def apply_operator_fingerprinted(self, operator, task, state, state_hash, copy_func):
+        """
+        Applies operator like apply_operator(), recording its changes so that the fingerprint of the new state
+        can be derived from state_hash in time proportional to the number of changes. Returns the new state and
+        its fingerprint.
+        """
+        trail = Trail()
+        replaced = False
+
+        def recorded(live_state, *args):
+            nonlocal replaced
+            # Writes through the copy-on-write views of a cow_copy() state bypass the trail, but replace the view.
+            views = [(name, value) for (name, value) in getattr(live_state, '__dict__', {}).items()
+                     if isinstance(value, CowView)]
+            proxy = TrailState(live_state, trail)
+            result = operator(proxy, *args)
+            if result is proxy:
+                if any(live_state.__dict__.get(name) is not view for (name, view) in views):
+                    replaced = True
+                return live_state
+            replaced = True
+            return result
+
+        new_state = self.apply_operator(recorded, task, state, copy_func)
+        if not new_state:
+            return new_state, None
+        elif replaced:
+            return new_state, state_fingerprint(new_state, self.static_names(new_state))
+        else:
+            return new_state, updated_fingerprint(state, new_state, state_hash, trail.entries,
+                                                  self.static_names(state))
+
+    def learn_copy_funcs(self, state, tasks, num_rollouts=10, verify_calls=100):
+        """
+        Runs num_rollouts random rollouts from state and tasks, observing which state attributes each operator
+        modifies and how deeply. Afterwards, each observed operator copies states with a generated copier that
+        copies only those attributes, down to that depth. Operators that were never observed keep using copy_func.
+        Each generated copier is checked during its first verify_calls uses, and permanently falls back to
+        copy_func if its operator modifies anything it does not copy. Afterwards, attributes a copier does not copy
+        stay protected by copy-on-write, but modifications below the learned depth of the attributes it does copy
+        go unchecked and reach the original state. See SpecializedCopier.
+        """
+        recorders = {name: WriteRecorder(self.copy_func) for name in self.operators}
+        self.operator_copy_funcs = recorders
+        for i in range(num_rollouts):
+            self.randhop(state, tasks)
+        self.operator_copy_funcs = {name: recorder.specialized(verify_calls) for (name, recorder) in recorders.items()
+                                    if recorder.calls > 0}
+        return self.operator_copy_funcs
+
     def print_operators(self):
         print(f'OPERATORS: {", ".join(self.operators)}')
 
@@ -73,71 +191,384 @@ class Planner:
             print(msg)
             print(state)
 
+    def trace(self, event, plan_step, detail=None):
+        if self.tracer is not None:
+            self.tracer.emit(event, self.node_expansions, plan_step.depth(), plan_step.total_cost, detail)
+
     def pyhop(self, state, tasks, verbose=0):
         for plan in self.pyhop_generator(state, tasks, verbose):
             if plan:
                 return plan
 
     def anyhop(self, state, tasks, max_seconds=None, verbose=0, disable_branch_bound=False,
-               queue_init=lambda: SearchStack()):
+               queue_init=lambda: SearchStack(), transposition_table=None, lazy_successors=False):
         self.reset_node_expansions()
-        start_time = time.time()
-        plan_times = []
-        complete_search = True
-        for plan in self.pyhop_generator(state, tasks, verbose, disable_branch_bound, yield_cost=True,
-                                         queue_init=queue_init):
-            elapsed_time = time.time() - start_time
-            if max_seconds and elapsed_time > max_seconds:
-                complete_search = False
-                break
-            if plan:
-                plan_times.append((plan[0], plan[1], elapsed_time))
-        if complete_search:
-            print("anyhop(): Search complete.")
-        return plan_times
+        return anyhop_plan_times(self.pyhop_generator(state, tasks, verbose, disable_branch_bound, yield_cost=True,
+                                                      queue_init=queue_init, transposition_table=transposition_table,
+                                                      lazy_successors=lazy_successors), max_seconds)
 
     def pyhop_generator(self, state, tasks, verbose=0, disable_branch_bound=False, yield_cost=False,
-                        queue_init=lambda: SearchStack()):
+                        queue_init=lambda: SearchStack(), transposition_table=None, max_cost=None,
+                        lazy_successors=False):
+        """
+        If a TranspositionTable is given, a candidate is pruned when the same state and remaining tasks were
+        already reached at the same or lower cost. If max_cost is given, only plans cheaper than it are sought.
+
+        If lazy_successors is set, operators are applied only to the candidates that survive branch-and-bound
+        pruning after being dequeued, rather than to every successor when it is enqueued.
+        """
         self.verbose = verbose
         self.log(1, f"** anyhop, verbose={self.verbose}: **\n   state = {state.__name__}\n   tasks = {tasks}")
+        tracer = self.tracer
         options = queue_init()
         options.enqueue_all_steps([PlanStep([], tasks, state, self.copy_func, self.cost_func)])
-        lowest_cost = None
+        lowest_cost = max_cost
         while not options.empty():
             candidate = options.dequeue_step()
             self.node_expansions += 1
-            if disable_branch_bound or lowest_cost is None or candidate.total_cost < lowest_cost:
-                self.log(2, f"depth {candidate.depth()} tasks {candidate.tasks}")
-                self.log(3, f"plan: {candidate.plan}")
+            if self.incumbent is not None and not disable_branch_bound:
+                lowest_cost = self.incumbent.bound(lowest_cost)
+            # The total cost is checked before the state is needed, so that a lazy step pruned by it never applies
+            # its operator, and the lower bound only once the state is known to exist.
+            if not (disable_branch_bound or lowest_cost is None or candidate.total_cost < lowest_cost):
+                if tracer is not None:
+                    tracer.emit(PRUNE, self.node_expansions, candidate.depth(), candidate.total_cost, 'bound')
+                yield None
+            elif not candidate.state:
+                if self.verbose >= 2:
+                    self.log(2, f"depth {candidate.depth()} operator failed")
+                if tracer is not None:
+                    tracer.emit(FAIL, self.node_expansions, candidate.depth(), candidate.total_cost, 'operator')
+                yield None
+            elif not (disable_branch_bound or lowest_cost is None or self.lower_bound is None or
+                      self.cost_bound(candidate) < lowest_cost):
+                if tracer is not None:
+                    tracer.emit(PRUNE, self.node_expansions, candidate.depth(), candidate.total_cost, 'bound')
+                yield None
+            elif transposition_table is not None and transposition_table.dominated(self.fingerprint(candidate),
+                                                                                   candidate.total_cost):
+                if self.verbose >= 2:
+                    self.log(2, f"depth {candidate.depth()} transposition pruned")
+                if tracer is not None:
+                    tracer.emit(PRUNE, self.node_expansions, candidate.depth(), candidate.total_cost,
+                                'transposition')
+                yield None
+            else:
+                if self.verbose >= 2:
+                    self.log(2, f"depth {candidate.depth()} tasks {candidate.tasks}")
+                if self.verbose >= 3:
+                    self.log(3, f"plan: {candidate.plan}")
                 if candidate.complete():
-                    self.log(3, f"depth {candidate.depth()} returns plan {candidate.plan}")
-                    self.log(1, f"** result = {candidate.plan}\n")
+                    plan = candidate.plan
+                    self.log(1, f"** result = {plan}\n")
+                    if tracer is not None:
+                        tracer.emit(YIELD, self.node_expansions, candidate.depth(), candidate.total_cost)
                     lowest_cost = candidate.total_cost
+                    if self.incumbent is not None:
+                        self.incumbent.offer(lowest_cost)
                     if yield_cost:
-                        yield candidate.plan, candidate.total_cost
+                        yield plan, candidate.total_cost
                     else:
-                        yield candidate.plan
+                        yield plan
+                else:
+                    options.enqueue_all_steps(candidate.successors(self, lazy_successors))
+                    yield None
+
+    def anyhop_weighted(self, state, tasks, max_seconds=None, verbose=0, heuristic=None, weights=(5, 3, 2, 1.5, 1)):
+        """
+        Restarting weighted A*: a best-first search with each of the decreasing weights in turn. Each search but
+        the last stops at its first plan, and every search prunes against the best plan found so far. The heuristic
+        takes a PlanStep, and defaults to the planner's lower_bound.
+        """
+        self.reset_node_expansions()
+        if heuristic is None:
+            heuristic = lambda step: self.cost_bound(step) - step.total_cost
+        return anyhop_plan_times(self.weighted_generator(state, tasks, verbose, heuristic, weights), max_seconds)
+
+    def weighted_generator(self, state, tasks, verbose, heuristic, weights):
+        lowest_cost = None
+        for i, weight in enumerate(weights):
+            self.log(1, f"** weight {weight} **")
+            for result in self.pyhop_generator(state, tasks, verbose, yield_cost=True, max_cost=lowest_cost,
+                                               queue_init=lambda: BestFirstQueue(heuristic, weight)):
+                yield result
+                if result:
+                    lowest_cost = result[1]
+                    if i < len(weights) - 1:
+                        break
+
+    def anyhop_beam(self, state, tasks, max_seconds=None, verbose=0, beam_width=10, widening=2, heuristic=None):
+        """
+        Beam search: expands every step of a layer, then keeps only the beam_width successors with the lowest
+        total_cost + heuristic(step). The heuristic takes a PlanStep, and defaults to the planner's lower_bound.
+
+        If widening is given, each pass is followed by another with a beam widening times wider, pruning against
+        the best plan found so far, until a pass discards no steps and has therefore searched exhaustively. It must
+        then be greater than 1, or the passes would never end.
+        """
+        if widening is not None and widening <= 1:
+            raise ValueError(f"anyhop_beam(): widening must be greater than 1 or None, not {widening}")
+        self.reset_node_expansions()
+        if heuristic is None:
+            heuristic = lambda step: self.cost_bound(step) - step.total_cost
+        return anyhop_plan_times(self.beam_generator(state, tasks, verbose, beam_width, widening, heuristic),
+                                 max_seconds)
+
+    def beam_generator(self, state, tasks, verbose, beam_width, widening, heuristic):
+        self.verbose = verbose
+        lowest_cost = None
+        truncated = True
+        while truncated:
+            self.log(1, f"** beam width {beam_width} **")
+            truncated = False
+            layer = [PlanStep([], tasks, state, self.copy_func, self.cost_func)]
+            while len(layer) > 0:
+                successors = []
+                for candidate in layer:
+                    self.node_expansions += 1
+                    if lowest_cost is None or self.cost_bound(candidate) < lowest_cost:
+                        if candidate.complete():
+                            lowest_cost = candidate.total_cost
+                            plan = candidate.plan
+                            self.log(1, f"** result = {plan}\n")
+                            self.trace(YIELD, candidate)
+                            yield plan, lowest_cost
+                            continue
+                        successors.extend(candidate.successors(self))
+                    else:
+                        self.trace(PRUNE, candidate, 'bound')
+                    yield None
+                if len(successors) > beam_width:
+                    truncated = True
+                    successors = heapq.nsmallest(beam_width, successors,
+                                                 key=lambda step: step.total_cost + heuristic(step))
+                layer = successors
+            if widening is None:
+                return
+            beam_width = max(beam_width + 1, int(beam_width * widening))
+
+    def anyhop_lds(self, state, tasks, max_seconds=None, verbose=0, max_discrepancies=None):
+        """
+        Limited discrepancy search: depth-first branch-and-bound passes that follow the first option of every
+        method and operator, except at up to k choice points, for k = 0, 1, 2, ... Options should therefore be
+        listed in order of preference. Passes end once one of them explores every option, or after
+        max_discrepancies if that is given.
+        """
+        self.reset_node_expansions()
+        return anyhop_plan_times(self.lds_generator(state, tasks, verbose, max_discrepancies), max_seconds)
+
+    def lds_generator(self, state, tasks, verbose, max_discrepancies):
+        self.verbose = verbose
+        lowest_cost = None
+        limit = 0
+        limited = True
+        while limited and (max_discrepancies is None or limit <= max_discrepancies):
+            self.log(1, f"** discrepancy limit {limit} **")
+            limited = False
+            stack = [(PlanStep([], tasks, state, self.copy_func, self.cost_func), 0)]
+            while stack:
+                candidate, discrepancies = stack.pop()
+                self.node_expansions += 1
+                if lowest_cost is None or self.cost_bound(candidate) < lowest_cost:
+                    if candidate.complete():
+                        lowest_cost = candidate.total_cost
+                        plan = candidate.plan
+                        self.log(1, f"** result = {plan}\n")
+                        self.trace(YIELD, candidate)
+                        yield plan, lowest_cost
+                        continue
+                    successors = candidate.successors(self)
+                    if len(successors) > 1 and discrepancies == limit:
+                        limited = True
+                        successors = successors[:1]
+                    for i in reversed(range(len(successors))):
+                        stack.append((successors[i], discrepancies if i == 0 else discrepancies + 1))
                 else:
-                    options.enqueue_all_steps(candidate.successors(self))
+                    self.trace(PRUNE, candidate, 'bound')
+                yield None
+            limit += 1
+
+    def anyhop_mcts(self, state, tasks, max_seconds, verbose=0, exploration=math.sqrt(2), use_tracker=False,
+                    ignore_single=True, tree=None):
+        """
+        Monte Carlo Tree Search. Each iteration descends the search tree by UCB1, expands a leaf, completes it with
+        a random rollout (guided by an ActionTracker if use_tracker is set), and backpropagates the outcome.
+        Rollouts are pruned against the best plan so far, as are tree nodes, and the search is complete once every
+        node of the tree has been pruned or fully explored.
+
+        Pass a MonteCarloTree as tree to continue a previous search instead of starting a new one.
+        """
+        self.reset_node_expansions()
+        self.verbose = verbose
+        if tree is None:
+            tree = MonteCarloTree(self, state, tasks, exploration, ActionTracker(tasks, state) if use_tracker else None,
+                                  ignore_single)
+        return anyhop_plan_times(tree.search(self), max_seconds)
+
+    def anyhop_nrpa(self, state, tasks, max_seconds, level=3, iterations=100, alpha=1.0, verbose=0):
+        """
+        Nested Rollout Policy Adaptation. Rollouts choose successors by a softmax policy over their
+        tracker_successor_key() options. Each level runs iterations searches of the level below, adapting the
+        policy toward the cheapest plan found at that level. Level 0 is a single rollout. Searches at the top
+        level restart with an empty policy until max_seconds elapse. As one engine of a portfolio, each rollout
+        stops once its cost bound reaches the best cost found by any of the engines.
+        """
+        self.reset_node_expansions()
+        self.verbose = verbose
+        search = PolicyAdaptation(self, state, tasks, iterations, alpha)
+        search.deadline = search.start_time + max_seconds
+        while time.time() < search.deadline:
+            search.search(level, {})
+        return search.plan_times
+
+    def anyhop_trail(self, state, tasks, max_seconds=None, verbose=0, disable_branch_bound=False):
+        self.reset_node_expansions()
+        return anyhop_plan_times(self.trail_generator(state, tasks, verbose, disable_branch_bound), max_seconds)
+
+    def trail_generator(self, state, tasks, verbose=0, disable_branch_bound=False):
+        """
+        Depth-first branch-and-bound search over a single live state. Operators modify the state in place through
+        a TrailState proxy, and backtracking reverts the trail instead of copying the state for every successor.
+
+        A domain qualifies if its operators modify and return the state object they receive, only modify it through
+        attribute assignment and dict/list/set operations on its attributes, and its methods do not modify the state.
+        Yields (plan, cost) pairs for each improved plan, and None after every other node.
+        """
+        self.verbose = verbose
+        self.log(1, f"** anyhop_trail, verbose={self.verbose}: **\n   state = {state.__name__}\n   tasks = {tasks}")
+        # A full copy, since writes through the views of a copy-on-write copy would bypass the trail.
+        state = copy_state(state, self.static_attributes)
+        trail = Trail()
+        live_state = TrailState(state, trail)
+        # Each entry is (trail mark, plan, tasks, cost, pending operator task or None).
+        stack = [(trail.mark(), LinkedPlan(), ConsList.from_list(tasks), 0, None)]
+        lowest_cost = None
+        tracer = self.tracer
+        while stack:
+            mark, plan, agenda, total_cost, pending = stack.pop()
+            self.node_expansions += 1
+            trail.undo_to(mark)
+            if self.incumbent is not None and not disable_branch_bound:
+                lowest_cost = self.incumbent.bound(lowest_cost)
+            if pending is not None:
+                total_cost += self.cost_func(state, pending)
+            if not (disable_branch_bound or lowest_cost is None or total_cost < lowest_cost):
+                if tracer is not None:
+                    tracer.emit(PRUNE, self.node_expansions, len(plan), total_cost, 'bound')
+                yield None
+                continue
+            if pending is not None:
+                result = self.operators[pending[0]](live_state, *pending[1:])
+                if not result:
+                    trail.undo_to(mark)
+                    if tracer is not None:
+                        tracer.emit(FAIL, self.node_expansions, len(plan), total_cost, 'operator')
                     yield None
+                    continue
+                elif result is not live_state:
+                    raise ValueError(f"anyhop_trail(): operator {pending[0]} must modify and return its state")
+                plan = plan.append(pending)
+                agenda = agenda.tail
+            if not (disable_branch_bound or lowest_cost is None or self.lower_bound is None or len(agenda) == 0 or
+                    total_cost + self.lower_bound(state, agenda) < lowest_cost):
+                trail.undo_to(mark)
+                if tracer is not None:
+                    tracer.emit(PRUNE, self.node_expansions, len(plan), total_cost, 'bound')
+                yield None
+                continue
+
+            if self.verbose >= 2:
+                self.log(2, f"depth {len(plan)} tasks {agenda}")
+            if len(agenda) == 0:
+                lowest_cost = total_cost
+                if self.incumbent is not None:
+                    self.incumbent.offer(lowest_cost)
+                result_plan = plan.to_list()
+                self.log(1, f"** result = {result_plan}\n")
+                if tracer is not None:
+                    tracer.emit(YIELD, self.node_expansions, len(plan), total_cost)
+                yield result_plan, total_cost
             else:
+                next_task = agenda.head if type(agenda.head) is tuple else (agenda.head,)
+                mark = trail.mark()
+                stack_size = len(stack)
+                if next_task[0] in self.operators:
+                    stack.append((mark, plan, agenda, total_cost, next_task))
+                if next_task[0] in self.methods:
+                    subtask_options = self.methods[next_task[0]](state, *next_task[1:])
+                    if subtask_options is not None:
+                        remaining = agenda.tail
+                        for subtasks in subtask_options.options:
+                            stack.append((mark, plan, remaining.push_all(subtasks), total_cost, None))
+                if self.profile is not None:
+                    self.profile.depths[len(plan)] += 1
+                if tracer is not None:
+                    tracer.emit(EXPAND if len(stack) > stack_size else FAIL, self.node_expansions, len(plan),
+                                total_cost, next_task[0])
                 yield None
 
+    def anyhop_parallel(self, state, tasks, max_seconds=None, num_workers=None, verbose=0):
+        """
+        Depth-first branch-and-bound search, as in anyhop(), shared among num_workers processes (default: one per
+        CPU) by work stealing. Workers prune against the best plan found by any of them. States must be picklable.
+        """
+        self.verbose = verbose
+        num_workers = default_num_workers() if num_workers is None else num_workers
+        if num_workers < 2:
+            return self.anyhop(state, tasks, max_seconds, verbose)
+        root = self.portable_step(PlanStep([], tasks, state, self.copy_func, self.cost_func))
+        plan_times, self.node_expansions, complete_search = run_work_stealing(self, root, num_workers, max_seconds)
+        if complete_search:
+            print("anyhop(): Search complete.")
+        return plan_times
+
+    def portable_step(self, plan_step) -> Tuple:
+        """Picklable representation of plan_step, for sending to another process."""
+        return plan_step.plan, plan_step.tasks.to_list(), plan_step.state, plan_step.total_cost
+
+    def restore_step(self, portable) -> 'PlanStep':
+        plan, tasks, state, total_cost = portable
+        return PlanStep(plan, tasks, state, self.copy_func, self.cost_func, past_cost=total_cost)
+
     def anyhop_best(self, state, tasks, max_seconds=None, verbose=0):
         plans = self.anyhop(state, tasks, max_seconds, verbose)
         return plans[-1][0]
 
+    def profiled(self, method_name, *args, **kwargs) -> Tuple[List[Tuple], SearchProfile]:
+        """
+        Runs self.method_name(*args, **kwargs), which must return an anytime trace, while its methods, operators,
+        copy_func and cost_func are timed. Returns the trace and the SearchProfile. Work done in other processes by
+        the parallel planners is not profiled.
+        """
+        profile = SearchProfile()
+        saved = self.operators, self.methods, self.copy_func, self.cost_func
+        self.operators = {name: profile.timed_operator(name, operator) for (name, operator) in self.operators.items()}
+        self.methods = {name: profile.timed_method(name, method) for (name, method) in self.methods.items()}
+        self.copy_func = profile.timed_copy(self.copy_func)
+        self.cost_func = profile.timed_cost(self.cost_func)
+        self.profile = profile
+        try:
+            return getattr(self, method_name)(*args, **kwargs), profile
+        finally:
+            self.operators, self.methods, self.copy_func, self.cost_func = saved
+            self.profile = None
+
     def anyhop_stats(self, state, tasks, max_seconds=None, verbose=0):
         plans = self.anyhop(state, tasks, max_seconds, verbose)
         return [(len(plan), cost, tm) for (plan, cost, tm) in plans]
 
     def randhop(self, state, tasks, max_cost=None, verbose=0):
         self.verbose = verbose
-        candidate = PlanStep([], tasks, state, self.copy_func, self.cost_func)
+        return self.random_completion(PlanStep([], tasks, state, self.copy_func, self.cost_func), max_cost)
+
+    def random_completion(self, candidate, max_cost=None):
+        """Completes candidate by choosing successors uniformly at random. Returns None on a dead end."""
         while not (candidate is None or candidate.complete()):
             successors = candidate.successors(self)
             self.node_expansions += 1
-            if len(successors) == 0 or max_cost is not None and candidate.total_cost >= max_cost:
+            if len(successors) == 0 or max_cost is not None and self.cost_bound(candidate) >= max_cost:
+                if len(successors) > 0:
+                    self.trace(PRUNE, candidate, 'bound')
                 return None
             candidate = successors[random.randint(0, len(successors) - 1)]
         return candidate
@@ -146,16 +577,46 @@ class Planner:
         self.reset_node_expansions()
         if use_max_cost:
             return anyhop_single_shots(lambda max_cost: self.randhop(state, tasks, max_cost=max_cost, verbose=verbose),
-                                       max_seconds)
+                                       max_seconds, self.incumbent)
         else:
             return anyhop_single_shots(lambda max_cost: self.randhop(state, tasks, max_cost=None, verbose=verbose),
-                                       max_seconds)
+                                       max_seconds, self.incumbent)
 
-    def anyhop_random_tracked(self, state, tasks, max_seconds, ignore_single=True, verbose=0):
+    def anyhop_random_tracked(self, state, tasks, max_seconds, ignore_single=True, verbose=0, use_max_cost=False):
+        """
+        Rollouts are cut off at the cost of the best plan so far if use_max_cost is set, and always when the planner
+        has a lower_bound, since only then can a rollout be abandoned before it reaches that cost.
+        """
         self.reset_node_expansions()
         tracker = ActionTracker(tasks, state)
-        return anyhop_single_shots(lambda max_cost: self.make_action_tracked_plan(tracker, verbose, ignore_single),
-                                   max_seconds)
+        use_max_cost = use_max_cost or self.lower_bound is not None
+        return anyhop_single_shots(
+            lambda max_cost: self.make_action_tracked_plan(tracker, verbose, ignore_single,
+                                                           max_cost if use_max_cost else None),
+            max_seconds, self.incumbent)
+
+    def anyhop_random_parallel(self, state, tasks, max_seconds, num_workers=None, use_max_cost=True, verbose=0,
+                               seed=None):
+        """
+        Runs anyhop_random() in num_workers processes (default: one per CPU) with separate random seeds derived from
+        seed. Workers share the cost of the best plan found so far, and each one prunes against it.
+        """
+        return self.run_parallel_rollouts('anyhop_random', num_workers, seed, state, tasks, max_seconds,
+                                          use_max_cost=use_max_cost, verbose=verbose)
+
+    def anyhop_random_tracked_parallel(self, state, tasks, max_seconds, num_workers=None, ignore_single=True,
+                                       verbose=0, seed=None):
+        """
+        Runs anyhop_random_tracked() in num_workers processes, as in anyhop_random_parallel(). Each worker learns
+        its own ActionTracker, and abandons rollouts that cannot beat the best plan of any worker.
+        """
+        return self.run_parallel_rollouts('anyhop_random_tracked', num_workers, seed, state, tasks, max_seconds,
+                                          ignore_single=ignore_single, verbose=verbose, use_max_cost=True)
+
+    def run_parallel_rollouts(self, method_name, num_workers, seed, *args, **kwargs):
+        num_workers = default_num_workers() if num_workers is None else num_workers
+        traces, self.node_expansions = run_parallel(self, [(method_name, args, kwargs)] * num_workers, seed)
+        return merge_plan_times(traces)
 
     def anyhop_random_tracked_dfs_seed(self, state, tasks, max_seconds, ignore_single=True, verbose=0):
         tracker = ActionTracker(tasks, state)
@@ -164,21 +625,43 @@ class Planner:
         def runner(max_cost):
             nonlocal seed_ran
             if seed_ran:
-                return self.make_action_tracked_plan(tracker, verbose, ignore_single)
+                return self.make_action_tracked_plan(tracker, verbose, ignore_single, max_cost)
             else:
                 seed_ran = True
-                return self.dfs_left_tracked_plan(tracker, verbose)
-
-        return anyhop_single_shots(runner, max_seconds)
-
-    def make_action_tracked_plan(self, action_tracker, verbose, ignore_single):
+                return self.dfs_left_tracked_plan(tracker, verbose, max_cost)
+
+        return anyhop_single_shots(runner, max_seconds, self.incumbent)
+
+    def anyhop_portfolio(self, state, tasks, max_seconds, engines=('dfs', 'random', 'tracked', 'tracked_dfs_seed'),
+                         verbose=0, seed=None):
+        """
+        Runs each of the named engines from PORTFOLIO_ENGINES in its own process. The engines share the cost of
+        the best plan found by any of them and prune against it. Returns a single anytime trace of
+        (plan, cost, elapsed, engine name) entries, in time order.
+        """
+        jobs = []
+        for name in engines:
+            method_name, kwargs = PORTFOLIO_ENGINES[name]
+            jobs.append((method_name, (state, tasks, max_seconds), dict(kwargs, verbose=verbose)))
+        traces, self.node_expansions = run_parallel(self, jobs, seed)
+        return merge_plan_times([[(plan, cost, elapsed, name) for (plan, cost, elapsed) in trace]
+                                 for (name, trace) in zip(engines, traces)])
+
+    def make_action_tracked_plan(self, action_tracker, verbose, ignore_single, max_cost=None):
         self.verbose = verbose
         candidate = PlanStep([], action_tracker.tasks, action_tracker.state, self.copy_func, self.cost_func)
+        return self.tracked_completion(candidate, action_tracker, ignore_single, max_cost)
+
+    def tracked_completion(self, candidate, action_tracker, ignore_single, max_cost=None):
+        """
+        Completes candidate by choosing successors as guided by action_tracker, then records the outcome in it.
+        Returns None on a dead end.
+        """
         chosen_methods = []
         while not (candidate is None or candidate.complete()):
             options = candidate.successors(self)
             self.node_expansions += 1
-            if len(options) == 0:
+            if len(options) == 0 or max_cost is not None and self.cost_bound(candidate) >= max_cost:
                 candidate = None
             elif ignore_single and len(options) == 1:
                 candidate = options[0]
@@ -197,13 +680,13 @@ class Planner:
                 action_tracker.option_outcomes[option].record(candidate.total_cost)
         return candidate
 
-    def dfs_left_tracked_plan(self, action_tracker, verbose):
+    def dfs_left_tracked_plan(self, action_tracker, verbose, max_cost=None):
         self.verbose = verbose
         candidate = PlanStep([], action_tracker.tasks, action_tracker.state, self.copy_func, self.cost_func)
         chosen_methods = []
         while not (candidate is None or candidate.complete()):
             options = candidate.successors(self)
-            if len(options) == 0:
+            if len(options) == 0 or max_cost is not None and self.cost_bound(candidate) >= max_cost:
                 candidate = None
             else:
                 candidate = options[0]
@@ -238,27 +721,76 @@ class Planner:
         return result
 
 
-def anyhop_single_shots(single_shot_planner, max_seconds):
+def anyhop_plan_times(plan_generator, max_seconds):
+    start_time = time.time()
+    plan_times = []
+    complete_search = True
+    for plan in plan_generator:
+        elapsed_time = time.time() - start_time
+        if max_seconds and elapsed_time > max_seconds:
+            complete_search = False
+            break
+        if plan:
+            plan_times.append((plan[0], plan[1], elapsed_time))
+    if complete_search:
+        print("anyhop(): Search complete.")
+    return plan_times
+
+
+def anyhop_single_shots(single_shot_planner, max_seconds, incumbent=None):
     start_time = time.time()
     elapsed_time = 0
     max_cost = None
     plan_times = []
     while elapsed_time < max_seconds:
+        if incumbent is not None:
+            max_cost = incumbent.bound(max_cost)
         plan_step = single_shot_planner(max_cost)
         elapsed_time = time.time() - start_time
         if plan_step is not None and (max_cost is None or plan_step.total_cost < max_cost):
             plan_times.append((plan_step.plan, plan_step.total_cost, elapsed_time))
             max_cost = plan_step.total_cost
+            if incumbent is not None:
+                incumbent.offer(max_cost)
     return plan_times
 
 
 class State:
-    def __init__(self, name):
+    # Names of attributes that no operator modifies. The default copier shares them between a state and its copies.
+    static_attributes = frozenset()
+
+    def __init__(self, name, static_attributes=None):
         self.__name__ = name
+        if static_attributes:
+            self.__static__ = frozenset(static_attributes)
 
     def __repr__(self):
         return '\n'.join(
-            [f"{self.__name__}.{name} = {val}" for (name, val) in vars(self).items() if name != "__name__"])
+            [f"{self.__name__}.{name} = {val}" for (name, val) in vars(self).items()
+             if name not in ("__name__", "__static__")])
+
+    def declare_static(self, *names):
+        self.__static__ = self.static_names().union(names)
+
+    def static_names(self) -> FrozenSet[str]:
+        return getattr(self, '__static__', type(self).static_attributes)
+
+
+def copy_state(state, static_attributes=frozenset()):
+    """
+    Deep copy of state, except that static attributes, declared either on the state or through
+    static_attributes, are shared by reference with the copy.
+    """
+    if isinstance(state, State):
+        static_attributes = static_attributes.union(state.static_names())
+    if len(static_attributes) == 0:
+        return copy.deepcopy(state)
+    memo = {}
+    for name in static_attributes:
+        value = getattr(state, name, None)
+        if value is not None:
+            memo[id(value)] = value
+    return copy.deepcopy(state, memo)
 
 
 class TaskList:
@@ -289,63 +821,286 @@ class TaskList:
         return not self.complete() and not self.failed()
 
 
-class PlanStep:
-    def __init__(self, plan, tasks, state, copy_func, cost_func, current_cost=0, past_cost=0):
+# Kinds of MemoCache keys, and the placeholder for a method result that is not in the cache.
+OPERATOR = 0
+METHOD = 1
+NOT_MEMOIZED = object()
+
+
+class SearchContext:
+    """
+    What the plan steps of one search share: the copy and cost functions, and the operator and method for each task
+    name, looked up in the planner the first time that name is the next task of a step.
+    """
+    __slots__ = ['copy_func', 'cost_func', 'dispatch_table']
+
+    def __init__(self, copy_func, cost_func):
         self.copy_func = copy_func
         self.cost_func = cost_func
-        self.plan = plan
-        self.tasks = tasks
+        self.dispatch_table = {}
+
+    def dispatch(self, planner, name) -> Tuple[Optional[Callable], Optional[Callable]]:
+        entry = self.dispatch_table.get(name)
+        if entry is None:
+            entry = (planner.operators.get(name), planner.methods.get(name))
+            self.dispatch_table[name] = entry
+        return entry
+
+
+class PlanStep:
+    __slots__ = ['context', 'linked_plan', 'tasks', 'state', 'total_cost', 'current_cost', 'state_hash', 'open_tasks']
+
+    def __init__(self, plan, tasks, state, copy_func, cost_func, current_cost=0, past_cost=0, state_hash=None,
+                 open_tasks=EMPTY, context=None):
+        self.context = SearchContext(copy_func, cost_func) if context is None else context
+        self.linked_plan = plan if type(plan) is LinkedPlan else LinkedPlan.from_list(plan)
+        self.tasks = tasks if type(tasks) is ConsList else ConsList.from_list(tasks)
         self.state = state
         self.total_cost = past_cost + current_cost
         self.current_cost = current_cost
+        self.state_hash = state_hash
+        # With a SubplanCache, the decomposed tasks still in progress, innermost first, as
+        # (cache key, plan length, total cost, remaining tasks) when their decomposition began.
+        self.open_tasks = open_tasks
+
+    def child(self, linked_plan, tasks, state, current_cost, state_hash, open_tasks) -> 'PlanStep':
+        result = object.__new__(PlanStep)
+        result.context = self.context
+        result.linked_plan = linked_plan
+        result.tasks = tasks
+        result.state = state
+        result.total_cost = self.total_cost + current_cost
+        result.current_cost = current_cost
+        result.state_hash = state_hash
+        result.open_tasks = open_tasks
+        return result
+
+    @property
+    def copy_func(self):
+        return self.context.copy_func
+
+    @property
+    def cost_func(self):
+        return self.context.cost_func
+
+    @property
+    def plan(self) -> List:
+        return self.linked_plan.to_list()
 
     def depth(self):
-        return len(self.plan)
+        return len(self.linked_plan)
 
     def complete(self):
         return len(self.tasks) == 0
 
-    def successors(self, planner) -> List:
+    def successors(self, planner, lazy=False) -> List:
+        """
+        If lazy is set, the successor by an operator is a PendingPlanStep, which applies the operator only when its
+        state is first needed.
+        """
         options = []
-        self.add_operator_options(options, planner)
-        self.add_method_options(options, planner)
-        if len(options) == 0:
-            planner.log(3, f"depth {self.depth()} returns failure")
+        next_task = self.next_task()
+        operator, method = self.context.dispatch(planner, next_task[0])
+        if operator is not None:
+            self.add_operator_options(options, planner, next_task, lazy)
+        if method is not None:
+            self.add_method_options(options, planner, next_task, method)
+        if planner.subplan_cache is not None:
+            for option in options:
+                option.close_tasks(planner.subplan_cache)
+        if planner.profile is not None:
+            planner.profile.depths[self.depth()] += 1
+        if planner.tracer is not None:
+            planner.tracer.emit(EXPAND if len(options) > 0 else FAIL, planner.node_expansions, self.depth(),
+                                self.total_cost, next_task[0])
         return options
 
-    def add_operator_options(self, options, planner):
-        next_task = self.next_task()
-        if type(next_task[0]) == list:
-            print(f"next_task: {next_task}")
-        if next_task[0] in planner.operators:
-            planner.log(3, f"depth {self.depth()} action {next_task}")
-            operator = planner.operators[next_task[0]]
-            newstate = operator(self.copy_func(self.state), *next_task[1:])
-            planner.log_state(3, f"depth {self.depth()} new state:", newstate)
+    def add_operator_options(self, options, planner, next_task, lazy=False):
+        if planner.frontier_cache is not None:
+            options.append(DerivedPlanStep(self, planner, next_task, self.tasks.tail,
+                                           self.context.cost_func(self.state, next_task)))
+        elif lazy:
+            options.append(PendingPlanStep(self, planner, next_task))
+        else:
+            newstate, state_hash = self.apply_next_operator(planner, next_task)
             if newstate:
-                options.append(PlanStep(self.plan + [next_task], self.tasks[1:], newstate, self.copy_func,
-                                        self.cost_func, past_cost=self.total_cost,
-                                        current_cost=self.cost_func(self.state, next_task)))
-
-    def add_method_options(self, options, planner):
-        next_task = self.next_task()
-        if next_task[0] in planner.methods:
-            planner.log(3, f"depth {self.depth()} method instance {next_task}")
-            method = planner.methods[next_task[0]]
+                options.append(self.child(self.linked_plan.append(next_task), self.tasks.tail, newstate,
+                                          self.context.cost_func(self.state, next_task), state_hash, self.open_tasks))
+
+    def apply_next_operator(self, planner, next_task) -> Tuple[Any, Optional[int]]:
+        """Applies the operator for next_task to a copy of this step's state. Returns the result and its hash."""
+        operator = self.context.dispatch(planner, next_task[0])[0]
+        copy_func = self.context.copy_func
+        outcome = None
+        if planner.memo is not None:
+            memo_key = (OPERATOR, freeze(next_task), planner.state_hash(self))
+            outcome = planner.memo.get(memo_key)
+        if outcome is not None:
+            newstate, state_hash = outcome
+        elif planner.incremental_fingerprints and self.state_hash is not None:
+            newstate, state_hash = planner.apply_operator_fingerprinted(operator, next_task, self.state,
+                                                                        self.state_hash, copy_func)
+        else:
+            newstate = planner.apply_operator(operator, next_task, self.state, copy_func)
+            state_hash = None
+        if planner.memo is not None and outcome is None:
+            planner.memo.put(memo_key, (newstate, state_hash))
+        return newstate, state_hash
+
+    def add_method_options(self, options, planner, next_task, method):
+        open_tasks = self.open_tasks
+        cached = None
+        if planner.subplan_cache is not None and planner.subplan_cache.caches(next_task):
+            cache_key = (freeze(next_task), planner.state_hash(self))
+            cached = planner.subplan_cache.get(cache_key)
+            open_tasks = open_tasks.push((cache_key, len(self.linked_plan), self.total_cost, self.tasks.tail))
+        if planner.memo is None:
             subtask_options = method(self.state, *next_task[1:])
-            if subtask_options is not None:
-                for subtasks in subtask_options.options:
-                    planner.log(3, f"depth {self.depth()} new tasks: {subtasks}")
-                    options.append(
-                        PlanStep(self.plan, subtasks + self.tasks[1:], self.state, self.copy_func, self.cost_func,
-                                 past_cost=self.total_cost))
+        else:
+            memo_key = (METHOD, freeze(next_task), planner.state_hash(self))
+            subtask_options = planner.memo.get(memo_key, NOT_MEMOIZED)
+            if subtask_options is NOT_MEMOIZED:
+                subtask_options = method(self.state, *next_task[1:])
+                planner.memo.put(memo_key, subtask_options)
+        if subtask_options is not None:
+            remaining = self.tasks.tail
+            for subtasks in subtask_options.options:
+                if planner.frontier_cache is not None:
+                    options.append(DerivedPlanStep(self, planner, None, remaining.push_all(subtasks), 0, open_tasks))
+                else:
+                    options.append(self.child(self.linked_plan, remaining.push_all(subtasks), self.state, 0,
+                                              self.state_hash, open_tasks))
+        if cached is not None:
+            # Last, so that depth-first search tries it first.
+            subplan, cost, state, state_hash = cached
+            options.append(self.child(self.linked_plan.extend(subplan), self.tasks.tail, state, cost, state_hash,
+                                      self.open_tasks))
+
+    def closes_task(self) -> bool:
+        return len(self.open_tasks) > 0 and self.open_tasks.head[3] is self.tasks
+
+    def close_tasks(self, subplan_cache):
+        """Records the subplan of every open task whose decomposition this step completes."""
+        while self.closes_task():
+            cache_key, plan_length, cost, remaining = self.open_tasks.head
+            subplan_cache.record(cache_key, self.linked_plan.since(plan_length), self.total_cost - cost, self.state,
+                                 self.state_hash)
+            self.open_tasks = self.open_tasks.tail
 
     def next_task(self):
-        result = self.tasks[0]
+        result = self.tasks.head
         if type(result) is tuple:
             return result
         else:
-            return tuple([result])
+            return result,
+
+
+class PendingPlanStep(PlanStep):
+    """
+    Successor of parent by the operator for task. Its cost is known at once, but the operator is applied to a copy
+    of the parent's state only when the state is first needed. If the operator fails, the step has no successors
+    and is never complete.
+    """
+    __slots__ = ['parent', 'planner', 'task', 'resulting_state']
+
+    def __init__(self, parent, planner, task):
+        self.parent = parent
+        self.planner = planner
+        self.task = task
+        PlanStep.__init__(self, parent.linked_plan.append(task), parent.tasks.tail, None, None, None,
+                          current_cost=parent.cost_func(parent.state, task), past_cost=parent.total_cost,
+                          open_tasks=parent.open_tasks, context=parent.context)
+
+    @property
+    def state(self):
+        if self.parent is not None:
+            self.resulting_state, self.state_hash = self.parent.apply_next_operator(self.planner, self.task)
+            self.parent = None
+            if self.planner.subplan_cache is not None:
+                self.close_tasks(self.planner.subplan_cache)
+        return self.resulting_state
+
+    @state.setter
+    def state(self, value):
+        self.resulting_state = value
+
+    def close_tasks(self, subplan_cache):
+        """Waits until the operator has been applied, and records nothing if it failed."""
+        if self.parent is None and self.resulting_state:
+            PlanStep.close_tasks(self, subplan_cache)
+
+    def complete(self):
+        return len(self.tasks) == 0 and bool(self.state)
+
+    def successors(self, planner, lazy=False) -> List:
+        return PlanStep.successors(self, planner, lazy) if self.state else []
+
+
+class DerivedPlanStep(PlanStep):
+    """
+    Plan step that does not hold on to its state. Its state is derived from its parent's whenever it is needed,
+    by applying the operator for task, or, if task is None, by sharing the parent's state. Derived states are kept
+    only in the planner's frontier_cache, so a queue of these steps holds states just for the steps it has
+    recently used. Operators must be deterministic. If the operator fails, the step has no successors and is
+    never complete.
+    """
+    __slots__ = ['parent', 'planner', 'task', 'failed']
+
+    def __init__(self, parent, planner, task, tasks, current_cost, open_tasks=None):
+        self.parent = parent
+        self.planner = planner
+        self.task = task
+        self.failed = False
+        PlanStep.__init__(self, parent.linked_plan if task is None else parent.linked_plan.append(task), tasks,
+                          None, None, None, current_cost=current_cost, past_cost=parent.total_cost,
+                          state_hash=parent.state_hash if task is None else None,
+                          open_tasks=parent.open_tasks if open_tasks is None else open_tasks, context=parent.context)
+
+    @property
+    def state(self):
+        if self.failed:
+            return None
+        cache = self.planner.frontier_cache
+        state = cache.get(self)
+        if state is None:
+            # Derive the states of uncached ancestors top-down, so that the depth of the chain is not limited by
+            # the depth of Python's stack.
+            chain = [self]
+            ancestor = self.parent
+            while type(ancestor) is DerivedPlanStep and cache.get(ancestor) is None:
+                chain.append(ancestor)
+                ancestor = ancestor.parent
+            for step in reversed(chain):
+                state = step.derive_state()
+                if not state:
+                    step.failed = True
+                    self.failed = True
+                    return None
+                cache.put(step, state)
+        return state
+
+    @state.setter
+    def state(self, value):
+        pass
+
+    def close_tasks(self, subplan_cache):
+        """Records nothing if the operator failed."""
+        if self.closes_task() and self.state:
+            PlanStep.close_tasks(self, subplan_cache)
+
+    def derive_state(self):
+        if self.task is None:
+            return self.parent.state
+        state, state_hash = self.parent.apply_next_operator(self.planner, self.task)
+        if self.state_hash is None:
+            self.state_hash = state_hash
+        return state
+
+    def complete(self):
+        return len(self.tasks) == 0 and bool(self.state)
+
+    def successors(self, planner, lazy=False) -> List:
+        return PlanStep.successors(self, planner, lazy) if self.state else []
 
 
 @total_ordering
@@ -392,8 +1147,175 @@ class OutcomeCounter:
         return self.total / self.num_succeeded
 
 
+class MonteCarloNode:
+    def __init__(self, step, parent=None):
+        self.step = step
+        self.parent = parent
+        self.children = None
+        self.visits = 0
+        self.reward = 0.0
+        self.exhausted = False
+
+    def ucb(self, exploration, log_parent_visits):
+        if self.visits == 0:
+            return math.inf
+        return self.reward / self.visits + exploration * math.sqrt(log_parent_visits / self.visits)
+
+    def select_child(self, exploration):
+        log_visits = math.log(self.visits) if self.visits > 0 else 0.0
+        return max((child for child in self.children if not child.exhausted),
+                   key=lambda child: child.ucb(exploration, log_visits))
+
+
+class MonteCarloTree:
+    """
+    Search tree of Planner.anyhop_mcts(). Rewards are scaled so that a rollout matching the best known plan
+    earns 1, costlier rollouts earn proportionally less, and failed rollouts earn 0.
+    """
+    def __init__(self, planner, state, tasks, exploration=math.sqrt(2), tracker=None, ignore_single=True):
+        self.root = MonteCarloNode(PlanStep([], tasks, state, planner.copy_func, planner.cost_func))
+        self.exploration = exploration
+        self.tracker = tracker
+        self.ignore_single = ignore_single
+        self.lowest_cost = None
+        self.iterations = 0
+
+    def search(self, planner):
+        """Yields (plan, cost) for each improved plan and None after every other iteration, until exhausted."""
+        while not self.root.exhausted:
+            outcome = self.iterate(planner)
+            if outcome is not None and (self.lowest_cost is None or outcome.total_cost < self.lowest_cost):
+                self.lowest_cost = outcome.total_cost
+                planner.log(1, f"** result = {outcome.plan}\n")
+                planner.trace(YIELD, outcome)
+                yield outcome.plan, outcome.total_cost
+            else:
+                yield None
+
+    def iterate(self, planner):
+        self.iterations += 1
+        node = self.root
+        while node.children is not None and not self.pruned(planner, node):
+            node = node.select_child(self.exploration)
+        if self.pruned(planner, node) or node.step.complete():
+            outcome = None if self.pruned(planner, node) else node.step
+            node.exhausted = True
+        else:
+            node.children = [MonteCarloNode(step, node) for step in node.step.successors(planner)]
+            planner.node_expansions += 1
+            if len(node.children) == 0:
+                node.exhausted = True
+                outcome = None
+            else:
+                node = node.children[0]
+                outcome = self.rollout(planner, node.step)
+        self.backpropagate(node, outcome)
+        return outcome
+
+    def pruned(self, planner, node) -> bool:
+        return self.lowest_cost is not None and planner.cost_bound(node.step) >= self.lowest_cost
+
+    def rollout(self, planner, step):
+        if self.tracker is None:
+            return planner.random_completion(step, self.lowest_cost)
+        else:
+            return planner.tracked_completion(step, self.tracker, self.ignore_single, self.lowest_cost)
+
+    def backpropagate(self, node, outcome):
+        if outcome is None:
+            reward = 0.0
+        else:
+            best = outcome.total_cost if self.lowest_cost is None else min(self.lowest_cost, outcome.total_cost)
+            reward = 1.0 if outcome.total_cost <= 0 else best / outcome.total_cost
+        while node is not None:
+            node.visits += 1
+            node.reward += reward
+            if node.children is not None and all(child.exhausted for child in node.children):
+                node.exhausted = True
+            node = node.parent
+
+
 def tracker_successor_key(successor):
-    return successor.tasks[0]
+    return successor.tasks.head
+
+
+class PolicyAdaptation:
+    """
+    State of a Planner.anyhop_nrpa() search. A policy maps tracker_successor_key() options to weights, and a
+    rollout records each choice it makes among several successors as (chosen key, keys of all options).
+    """
+    def __init__(self, planner, state, tasks, iterations, alpha):
+        self.planner = planner
+        self.state = state
+        self.tasks = tasks
+        self.iterations = iterations
+        self.alpha = alpha
+        self.start_time = time.time()
+        self.deadline = None
+        self.lowest_cost = None
+        self.plan_times = []
+
+    def search(self, level, policy) -> Tuple[Optional[float], List]:
+        """Returns the cost and choices of the cheapest plan found, or (None, []) if every rollout failed."""
+        if level == 0:
+            return self.rollout(policy)
+        best_cost, best_choices = None, []
+        for i in range(self.iterations):
+            if self.deadline is not None and time.time() >= self.deadline:
+                break
+            cost, choices = self.search(level - 1, policy)
+            if cost is not None and (best_cost is None or cost <= best_cost):
+                best_cost, best_choices = cost, choices
+            if best_cost is not None:
+                policy = adapted_policy(policy, best_choices, self.alpha)
+        return best_cost, best_choices
+
+    def rollout(self, policy) -> Tuple[Optional[float], List]:
+        planner = self.planner
+        candidate = PlanStep([], self.tasks, self.state, planner.copy_func, planner.cost_func)
+        max_cost = None if planner.incumbent is None else planner.incumbent.get()
+        choices = []
+        while not candidate.complete():
+            options = candidate.successors(planner)
+            planner.node_expansions += 1
+            if len(options) == 0 or max_cost is not None and planner.cost_bound(candidate) >= max_cost:
+                return None, choices
+            elif len(options) == 1:
+                candidate = options[0]
+            else:
+                keys = [tracker_successor_key(option) for option in options]
+                chosen = random.choices(range(len(options)), softmax_weights(policy, keys))[0]
+                choices.append((keys[chosen], keys))
+                candidate = options[chosen]
+        self.record(candidate)
+        return candidate.total_cost, choices
+
+    def record(self, candidate):
+        if self.planner.incumbent is not None:
+            self.lowest_cost = self.planner.incumbent.bound(self.lowest_cost)
+        if self.lowest_cost is None or candidate.total_cost < self.lowest_cost:
+            self.lowest_cost = candidate.total_cost
+            self.plan_times.append((candidate.plan, candidate.total_cost, time.time() - self.start_time))
+            if self.planner.incumbent is not None:
+                self.planner.incumbent.offer(self.lowest_cost)
+
+
+def softmax_weights(policy, keys) -> List[float]:
+    values = [policy.get(key, 0.0) for key in keys]
+    highest = max(values)
+    return [math.exp(value - highest) for value in values]
+
+
+def adapted_policy(policy, choices, alpha):
+    """Copy of policy shifted by a gradient step of size alpha toward making each of choices."""
+    result = dict(policy)
+    for chosen, keys in choices:
+        weights = softmax_weights(policy, keys)
+        total = sum(weights)
+        result[chosen] = result.get(chosen, 0.0) + alpha
+        for key, weight in zip(keys, weights):
+            result[key] = result.get(key, 0.0) - alpha * weight / total
+    return result
 
 
 class ActionTracker:
@@ -0,0 +1,785 @@
+import os
+import random
+import tempfile
+import unittest
+
+from pyhop_anytime.pyhop import State, TaskList, Planner, PlanStep, MonteCarloTree, copy_state, adapted_policy, \
+    softmax_weights, PolicyAdaptation, ActionTracker
+from pyhop_anytime.persistent import LinkedPlan, ConsList
+from pyhop_anytime.trail import Trail, TrailState
+from pyhop_anytime.copiers import SpecializedCopier
+from pyhop_anytime.cow import cow_copy
+from pyhop_anytime.search_queues import HybridQueue, TranspositionTable, BestFirstQueue, MonteCarloPlannerHeap, MemoCache, \
+    SubplanCache
+from pyhop_anytime.fingerprint import state_fingerprint, updated_fingerprint
+from pyhop_anytime.parallel import RolloutEvaluator, SharedIncumbent, run_parallel
+from pyhop_anytime.profiling import SearchProfile
+from pyhop_anytime.trace import ListTraceSink, JsonlTraceSink, read_jsonl_trace, EXPAND, PRUNE, YIELD, FAIL
+
+
+def go(state, entity, start, end):
+    if state.loc[entity] == start and end in state.connected[start] and end not in state.visited[entity]:
+        state.loc[entity] = end
+        state.visited[entity].append(end)
+        return state
+
+
+def find_route(state, entity, start, end):
+    if start == end:
+        return TaskList(completed=True)
+    elif end in state.connected[start]:
+        return TaskList(options=[('go', entity, start, end)])
+    else:
+        return TaskList(options=[[('go', entity, start, neighbor), ('find_route', entity, neighbor, end)]
+                                 for neighbor in state.connected[start]])
+
+
+def make_travel_planner():
+    planner = Planner()
+    planner.declare_operators(go)
+    planner.declare_methods(find_route)
+    return planner
+
+
+def make_travel_state():
+    state = State('3rd-floor')
+    state.visited = {'robot': []}
+    state.loc = {'robot': 'mcrey312'}
+    state.connected = {'mcrey312': ['hallway', 'mcrey314'],
+                       'hallway': ['mcrey312', 'mcrey314', 'lounge'],
+                       'mcrey314': ['mcrey312', 'hallway'],
+                       'lounge': ['hallway', 'copyroom'],
+                       'copyroom': ['lounge']}
+    return state, [('find_route', 'robot', 'mcrey312', 'copyroom')]
+
+
+def succeed(state):
+    return state
+
+
+def fail(state):
+    return None
+
+
+def choose(state):
+    return TaskList([[('succeed',)], [('fail',)]])
+
+
+def make_choice_planner(**kwargs):
+    planner = Planner(**kwargs)
+    planner.declare_operators(succeed, fail)
+    planner.declare_methods(choose)
+    return planner
+
+
+def hops_to_destination(state, tasks):
+    """Admissible lower bound: a route needs at least as many moves as the breadth-first distance it covers."""
+    total = 0
+    for task in tasks:
+        if task[0] == 'find_route':
+            entity, start, end = task[1:]
+            distances = {start: 0}
+            frontier = [start]
+            while end not in distances and frontier:
+                location = frontier.pop(0)
+                for neighbor in state.connected[location]:
+                    if neighbor not in distances:
+                        distances[neighbor] = distances[location] + 1
+                        frontier.append(neighbor)
+            total += distances.get(end, 0)
+    return total
+
+
+SHORTEST_ROUTE = [('go', 'robot', 'mcrey312', 'hallway'), ('go', 'robot', 'hallway', 'lounge'),
+                  ('go', 'robot', 'lounge', 'copyroom')]
+
+
+class PyhopTest(unittest.TestCase):
+    def test_anyhop_finds_shortest(self):
+        state, tasks = make_travel_state()
+        plan_times = make_travel_planner().anyhop(state, tasks)
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        self.assertEqual(3, plan_times[-1][1])
+
+    def test_anyhop_trail_matches_anyhop(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        expected = [(plan, cost) for (plan, cost, tm) in planner.anyhop(state, tasks)]
+        self.assertEqual(expected, [(plan, cost) for (plan, cost, tm) in planner.anyhop_trail(state, tasks)])
+        self.assertEqual({'robot': []}, state.visited)
+
+    def test_anyhop_trail_with_cow_copy(self):
+        state, tasks = make_travel_state()
+        planner = Planner(copy_func=cow_copy)
+        planner.declare_operators(go)
+        planner.declare_methods(find_route)
+        expected = [(plan, cost) for (plan, cost, tm) in planner.anyhop(state, tasks)]
+        self.assertEqual(expected, [(plan, cost) for (plan, cost, tm) in planner.anyhop_trail(state, tasks)])
+        self.assertEqual({'robot': []}, state.visited)
+
+    def test_trail_undo(self):
+        state, tasks = make_travel_state()
+        state.seen = {'mcrey312'}
+        trail = Trail()
+        live = TrailState(state, trail)
+        live.loc['robot'] = 'hallway'
+        live.loc['taxi'] = 'lounge'
+        live.visited['robot'].append('hallway')
+        live.visited['robot'].remove('hallway')
+        live.seen.add('hallway')
+        live.holding = 'package'
+        self.assertEqual('hallway', state.loc['robot'])
+        trail.undo_to(0)
+        self.assertEqual({'robot': 'mcrey312'}, state.loc)
+        self.assertEqual({'robot': []}, state.visited)
+        self.assertEqual({'mcrey312'}, state.seen)
+        self.assertFalse(hasattr(state, 'holding'))
+
+    def test_trail_views_forward_reads(self):
+        state, tasks = make_travel_state()
+        state.path = [1]
+        state.seen = {1}
+        trail = Trail()
+        live = TrailState(state, trail)
+        live.path = live.path + [2]
+        live.path = [0] + live.path
+        self.assertEqual([0, 1, 2, 0, 1, 2], live.path * 2)
+        self.assertTrue(live.path < [1])
+        self.assertEqual({1, 2}, {2} | live.seen)
+        self.assertEqual({'robot': 'mcrey312', 'taxi': 'lounge'}, live.loc | {'taxi': 'lounge'})
+        self.assertTrue(live.seen.issubset({1, 2}))
+        live.seen &= {2}
+        live.path *= 2
+        with self.assertRaises(KeyError):
+            live.seen.remove(5)
+        trail.undo_to(0)
+        self.assertEqual([1], state.path)
+        self.assertEqual({1}, state.seen)
+
+    def test_trail_iteration_records_nested_writes(self):
+        state = State('stacks')
+        state.stacks = [['a', 'b'], ['c'], ['d']]
+        trail = Trail()
+        live = TrailState(state, trail)
+        for stack in live.stacks:
+            if 'b' in stack:
+                stack.remove('b')
+        for stack in reversed(live.stacks):
+            stack.append('e')
+            break
+        live.stacks[1:2][0].append('f')
+        self.assertEqual([['a'], ['c', 'f'], ['d', 'e']], state.stacks)
+        trail.undo_to(0)
+        self.assertEqual([['a', 'b'], ['c'], ['d']], state.stacks)
+
+    def test_static_attributes_are_shared(self):
+        state, tasks = make_travel_state()
+        state.declare_static('connected')
+        copied = copy_state(state)
+        self.assertIs(state.connected, copied.connected)
+        self.assertIsNot(state.loc, copied.loc)
+        self.assertNotIn('__static__', repr(copied))
+
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.declare_static_attributes('connected')
+        copied = planner.copy_func(state)
+        self.assertIs(state.connected, copied.connected)
+        self.assertIsNot(state.visited, copied.visited)
+        self.assertEqual(SHORTEST_ROUTE, planner.anyhop(state, tasks)[-1][0])
+
+    def test_learned_copy_funcs(self):
+        random.seed(2)
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        copiers = planner.learn_copy_funcs(state, tasks)
+        self.assertEqual({'loc': 1, 'visited': 2}, copiers['go'].copy_depths)
+        copied = copiers['go'](state)
+        self.assertIs(state.connected, copied.connected.target)
+        self.assertIsNot(state.visited['robot'], copied.visited['robot'])
+        self.assertEqual(SHORTEST_ROUTE, planner.anyhop(state, tasks)[-1][0])
+        self.assertTrue(copiers['go'].covered)
+
+    def test_specialized_copier_falls_back(self):
+        state, tasks = make_travel_state()
+        copier = SpecializedCopier({'loc': 1}, {'loc': dict}, copy_state, 10)
+        result = copier.apply(go, state, ('robot', 'mcrey312', 'hallway'))
+        self.assertFalse(copier.covered)
+        self.assertEqual({'robot': []}, state.visited)
+        self.assertEqual({'robot': ['hallway']}, result.visited)
+        self.assertEqual({'robot': 'mcrey312'}, state.loc)
+
+    def test_specialized_copier_protects_uncovered_attributes(self):
+        def log_go(state, entity, start, end):
+            state.log.append(end)
+            return go(state, entity, start, end)
+
+        state, tasks = make_travel_state()
+        state.log = []
+        copier = SpecializedCopier({'loc': 1, 'visited': 2}, {'loc': dict, 'visited': dict}, copy_state, 0)
+        result = copier.apply(log_go, state, ('robot', 'mcrey312', 'hallway'))
+        result = copier.apply(log_go, result, ('robot', 'hallway', 'lounge'))
+        self.assertEqual(['hallway', 'lounge'], result.log)
+        self.assertEqual(['lounge'], result.visited['robot'][1:])
+        self.assertEqual([], state.log)
+        self.assertEqual({'robot': []}, state.visited)
+
+    def test_cow_copy(self):
+        state, tasks = make_travel_state()
+        child = cow_copy(state)
+        grandchild = go(cow_copy(child), 'robot', 'mcrey312', 'hallway')
+        self.assertIs(state.connected, child.connected.target)
+        self.assertEqual({'robot': 'mcrey312'}, state.loc)
+        self.assertEqual({'robot': []}, child.visited)
+        self.assertEqual({'robot': ['hallway']}, grandchild.visited)
+        self.assertIs(state.connected, grandchild.connected.target)
+
+        planner = Planner(copy_func=cow_copy)
+        planner.declare_operators(go)
+        planner.declare_methods(find_route)
+        self.assertEqual(SHORTEST_ROUTE, planner.anyhop(state, tasks)[-1][0])
+
+    def test_cow_views_follow_writes(self):
+        state, tasks = make_travel_state()
+        state.items = [1, 2]
+        child = cow_copy(state)
+        loc = child.loc
+        loc['robot'] = 'hallway'
+        self.assertEqual('hallway', loc['robot'])
+        items = child.items
+        items.append(3)
+        self.assertEqual(3, len(items))
+        visited = child.visited
+        robot_visits = child.visited['robot']
+        visited['robot'].append('hallway')
+        self.assertEqual(['hallway'], visited['robot'])
+        self.assertEqual(['hallway'], robot_visits)
+        self.assertEqual({'robot': 'mcrey312'}, state.loc)
+        self.assertEqual([1, 2], state.items)
+        self.assertEqual({'robot': []}, state.visited)
+
+    def test_cow_list_iteration_copies_on_write(self):
+        state = State('stacks')
+        state.stacks = [['a', 'b'], ['c'], ['d']]
+        child = cow_copy(state)
+        for stack in child.stacks:
+            if 'b' in stack:
+                stack.remove('b')
+        for stack in reversed(child.stacks):
+            stack.append('e')
+            break
+        child.stacks[1:2][0].append('f')
+        self.assertEqual([['a'], ['c', 'f'], ['d', 'e']], child.stacks)
+        self.assertEqual([['a', 'b'], ['c'], ['d']], state.stacks)
+
+    def test_cow_views_survive_rebinding(self):
+        state = State('room')
+        state.holding = ['a', 'b']
+        state.floor = []
+        child = cow_copy(state)
+        items = child.holding
+        child.holding = []
+        child.floor.extend(items)
+        items.append('c')
+        self.assertEqual(['a', 'b'], child.floor)
+        self.assertEqual([], child.holding)
+        self.assertEqual(['a', 'b', 'c'], items)
+        self.assertEqual(['a', 'b'], state.holding)
+
+    def test_transposition_table(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        table = TranspositionTable()
+        self.assertEqual(SHORTEST_ROUTE, planner.anyhop(state, tasks, transposition_table=table)[-1][0])
+
+        table = TranspositionTable(max_entries=2)
+        self.assertFalse(table.dominated('a', 5))
+        self.assertTrue(table.dominated('a', 5))
+        self.assertFalse(table.dominated('a', 4))
+        self.assertFalse(table.dominated('b', 1))
+        self.assertFalse(table.dominated('c', 1))
+        self.assertEqual(2, len(table))
+        self.assertFalse(table.dominated('a', 4))
+        self.assertEqual(2, table.evictions)
+
+    def test_agenda_fingerprint(self):
+        shared = ConsList.from_list([('deliver', ['p1', 'p2'])])
+        rebuilt = ConsList.from_list([('go', 1)] + shared.to_list())
+        self.assertEqual(shared.push(('go', 1)).fingerprint(), rebuilt.fingerprint())
+        self.assertNotEqual(shared.push(('go', 1)).fingerprint(), shared.push(('go', 2)).fingerprint())
+
+    def test_incremental_fingerprints(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.incremental_fingerprints = True
+        frontier = [PlanStep([], tasks, state, planner.copy_func, planner.cost_func)]
+        planner.fingerprint(frontier[0])
+        checked = 0
+        while frontier:
+            step = frontier.pop()
+            self.assertEqual(state_fingerprint(step.state), step.state_hash)
+            if step.tasks:
+                frontier.extend(step.successors(planner))
+            checked += 1
+        self.assertGreater(checked, 10)
+
+    def test_state_hash_ignores_state_static_attributes(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        step = PlanStep([], tasks, state, planner.copy_func, planner.cost_func)
+        full_hash = planner.state_hash(step)
+        state.declare_static('connected')
+        step = PlanStep([], tasks, state, planner.copy_func, planner.cost_func)
+        self.assertEqual(state_fingerprint(state, frozenset(['connected'])), planner.state_hash(step))
+        self.assertNotEqual(full_hash, planner.state_hash(step))
+
+    def test_incremental_fingerprints_with_cow_copy(self):
+        def increment(state, name):
+            state.counts[name] += 1
+            return state
+
+        def note(state, count):
+            return state
+
+        def check(state):
+            return TaskList([('note', state.counts['a'])])
+
+        planner = Planner(copy_func=cow_copy, incremental_fingerprints=True, memo=MemoCache())
+        planner.declare_operators(increment, note)
+        planner.declare_methods(check)
+        state = State('counter')
+        state.counts = {'a': 0}
+        plan = planner.anyhop(state, [('check',), ('increment', 'a'), ('check',)])[-1][0]
+        self.assertEqual([('note', 0), ('increment', 'a'), ('note', 1)], plan)
+
+    def test_updated_fingerprint(self):
+        state, tasks = make_travel_state()
+        state.seen = {'mcrey312'}
+        state.at = 'mcrey312'
+        new_state = copy_state(state)
+        trail = Trail()
+        live = TrailState(new_state, trail)
+        live.seen.add('hallway')
+        live.seen.discard('mcrey312')
+        live.loc['taxi'] = 'lounge'
+        live.visited['robot'].append('hallway')
+        live.at = 'hallway'
+        live.holding = []
+        expected = state_fingerprint(new_state)
+        self.assertNotEqual(state_fingerprint(state), expected)
+        self.assertEqual(expected, updated_fingerprint(state, new_state, state_fingerprint(state), trail.entries))
+
+    def test_lower_bound_prunes(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        unbounded = planner.anyhop(state, tasks)
+        unbounded_expansions = planner.node_expansions
+        planner.lower_bound = hops_to_destination
+        for plan_times in (planner.anyhop(state, tasks), planner.anyhop_trail(state, tasks)):
+            self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+            self.assertEqual(unbounded[-1][1], plan_times[-1][1])
+            self.assertLess(planner.node_expansions, unbounded_expansions)
+
+    def test_lower_bound_cuts_rollouts(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.lower_bound = lambda state, tasks: 10
+        self.assertIsNone(planner.randhop(state, tasks, max_cost=5))
+        self.assertEqual(10, planner.cost_bound(PlanStep([], tasks, state, planner.copy_func, planner.cost_func)))
+        max_costs = []
+        rollout = planner.make_action_tracked_plan
+
+        def recorded_rollout(tracker, verbose, ignore_single, max_cost=None):
+            max_costs.append(max_cost)
+            return rollout(tracker, verbose, ignore_single, max_cost)
+
+        planner.make_action_tracked_plan = recorded_rollout
+        plan_times = planner.anyhop_random_tracked(state, tasks, 0.05)
+        self.assertEqual(plan_times[-1][1], max_costs[-1])
+
+    def test_best_first_queue_order(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        shallow = PlanStep([], tasks, state, planner.copy_func, planner.cost_func, past_cost=2)
+        deep = PlanStep([('go', 'robot', 'mcrey312', 'hallway')], tasks, state, planner.copy_func, planner.cost_func,
+                        past_cost=2)
+        cheap = PlanStep([], tasks, state, planner.copy_func, planner.cost_func, past_cost=1)
+        queue = BestFirstQueue(heuristic=lambda step: 1, weight=2)
+        queue.enqueue_all_steps([shallow, deep, cheap])
+        self.assertEqual([cheap, deep, shallow], [queue.dequeue_step() for i in range(3)])
+        self.assertTrue(queue.empty())
+
+    def test_anyhop_weighted(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        plan_times = planner.anyhop_weighted(state, tasks, heuristic=lambda step: hops_to_destination(step.state,
+                                                                                                     step.tasks))
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        for i in range(1, len(plan_times)):
+            self.assertLess(plan_times[i][1], plan_times[i - 1][1])
+
+    def test_anyhop_beam(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        plan_times = planner.anyhop_beam(state, tasks, beam_width=1)
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        for i in range(1, len(plan_times)):
+            self.assertLess(plan_times[i][1], plan_times[i - 1][1])
+        single_pass = planner.anyhop_beam(state, tasks, beam_width=1, widening=None)
+        self.assertLessEqual(len(single_pass), len(plan_times))
+        with self.assertRaises(ValueError):
+            planner.anyhop_beam(state, tasks, beam_width=1, widening=1)
+        self.assertEqual(SHORTEST_ROUTE, planner.anyhop_beam(state, tasks, beam_width=1, widening=1.1)[-1][0])
+
+    def test_anyhop_lds(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        plan_times = planner.anyhop_lds(state, tasks)
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        for i in range(1, len(plan_times)):
+            self.assertLess(plan_times[i][1], plan_times[i - 1][1])
+        full_expansions = planner.node_expansions
+        self.assertEqual([], planner.anyhop_lds(state, tasks, max_discrepancies=0))
+        self.assertLess(planner.node_expansions, full_expansions)
+
+    def test_anyhop_mcts(self):
+        random.seed(1)
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        for use_tracker in (False, True):
+            plan_times = planner.anyhop_mcts(state, tasks, 5, use_tracker=use_tracker)
+            self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+
+    def test_mcts_tree_reuse(self):
+        random.seed(1)
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        tree = MonteCarloTree(planner, state, tasks)
+        planner.anyhop_mcts(state, tasks, 5, tree=tree)
+        self.assertTrue(tree.root.exhausted)
+        self.assertEqual(3, tree.lowest_cost)
+        iterations = tree.iterations
+        self.assertEqual([], planner.anyhop_mcts(state, tasks, 5, tree=tree))
+        self.assertEqual(iterations, tree.iterations)
+
+    def test_monte_carlo_planner_heap(self):
+        random.seed(1)
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        plan_times = planner.anyhop(state, tasks, queue_init=lambda: MonteCarloPlannerHeap(planner))
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+
+    def test_rollout_evaluator(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        steps = PlanStep([], tasks, state, planner.copy_func, planner.cost_func).successors(planner)
+        with RolloutEvaluator(planner, num_workers=2, seed=5) as evaluator:
+            ratings = evaluator.ratings(steps, 4)
+        with RolloutEvaluator(planner, num_workers=1, seed=5) as evaluator:
+            self.assertEqual(ratings, evaluator.ratings(steps, 4))
+            plan_times = planner.anyhop(state, tasks,
+                                        queue_init=lambda: MonteCarloPlannerHeap(planner, evaluator=evaluator))
+        self.assertEqual(len(steps), len(ratings))
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+
+    def test_anyhop_nrpa(self):
+        random.seed(1)
+        state, tasks = make_travel_state()
+        plan_times = make_travel_planner().anyhop_nrpa(state, tasks, 0.2, level=2, iterations=10)
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        for i in range(1, len(plan_times)):
+            self.assertLess(plan_times[i][1], plan_times[i - 1][1])
+
+    def test_rollouts_prune_against_incumbent(self):
+        random.seed(1)
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.incumbent = SharedIncumbent()
+        planner.incumbent.offer(1)
+        self.assertIsNone(PolicyAdaptation(planner, state, tasks, 1, 1.0).rollout({})[0])
+        self.assertEqual([], planner.anyhop_random_tracked_dfs_seed(state, tasks, 0.05))
+        self.assertIsNone(planner.dfs_left_tracked_plan(ActionTracker(tasks, state), 0, 1))
+
+    def test_adapted_policy(self):
+        keys = ['a', 'b', 'c']
+        policy = adapted_policy({}, [('b', keys)], 1.0)
+        weights = softmax_weights(policy, keys)
+        self.assertGreater(weights[1], weights[0])
+        self.assertAlmostEqual(weights[0], weights[2])
+        self.assertAlmostEqual(0.0, sum(policy.values()))
+
+    def test_memo_cache(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        expected = planner.anyhop(state, tasks)
+        for incremental in (False, True):
+            planner.memo = MemoCache()
+            planner.incremental_fingerprints = incremental
+            self.assertEqual([plan_time[:2] for plan_time in expected],
+                             [plan_time[:2] for plan_time in planner.anyhop(state, tasks)])
+            random.seed(1)
+            planner.n_random(state, tasks, 20)
+            self.assertGreater(planner.memo.hits, 0)
+            self.assertEqual(len(planner.memo), planner.memo.misses)
+
+    def test_memo_cache_eviction(self):
+        memo = MemoCache(max_entries=2)
+        for key in 'abc':
+            memo.put(key, key.upper())
+        self.assertIsNone(memo.get('a'))
+        self.assertEqual('C', memo.get('c'))
+        self.assertEqual((1, 1, 1), (memo.hits, memo.misses, memo.evictions))
+
+    def test_subplan_cache(self):
+        random.seed(1)
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.subplan_cache = SubplanCache({'find_route'})
+        first = None
+        while first is None:
+            first = planner.randhop(state, tasks)
+        key = (tasks[0], state_fingerprint(state))
+        self.assertEqual((first.plan, first.total_cost), planner.subplan_cache.get(key)[:2])
+        root = PlanStep([], tasks, state, planner.copy_func, planner.cost_func)
+        options = root.successors(planner)
+        spliced = options[-1]
+        self.assertEqual(first.plan, spliced.plan)
+        self.assertEqual(first.total_cost, spliced.total_cost)
+        self.assertIs(first.state, spliced.state)
+        uncached = make_travel_planner()
+        self.assertEqual(len(root.successors(uncached)) + 1, len(options))
+
+    def test_subplan_cache_keeps_decomposing(self):
+        random.seed(5)
+        state, tasks = make_travel_state()
+        tasks = [('find_route', 'robot', 'mcrey312', 'lounge'), ('find_route', 'robot', 'lounge', 'copyroom')]
+        planner = make_travel_planner()
+        planner.subplan_cache = SubplanCache({'find_route'})
+        costs = {plan.total_cost for plan in (planner.randhop(state, tasks) for i in range(200)) if plan is not None}
+        self.assertEqual(3, min(costs))
+        self.assertGreater(len(costs), 1)
+
+    def test_subplan_cache_nested(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.subplan_cache = SubplanCache({'find_route'})
+        plan_times = planner.anyhop(state, tasks)
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        lounge = planner.plan_states(state, SHORTEST_ROUTE[:2])[-1]
+        cached = planner.subplan_cache.get((('find_route', 'robot', 'lounge', 'copyroom'), state_fingerprint(lounge)))
+        self.assertEqual([SHORTEST_ROUTE[2]], cached[0])
+
+    def test_linked_plan_extend_since(self):
+        plan = LinkedPlan.from_list(['a', 'b']).extend(['c', 'd'])
+        self.assertEqual(['a', 'b', 'c', 'd'], plan.to_list())
+        self.assertEqual(['c', 'd'], plan.since(2))
+        self.assertEqual([], plan.since(4))
+
+    def test_lazy_successors(self):
+        state, tasks = make_travel_state()
+        copies = 0
+
+        def counting_copy(state):
+            nonlocal copies
+            copies += 1
+            return copy_state(state)
+
+        planner = Planner(copy_func=counting_copy)
+        planner.declare_operators(go)
+        planner.declare_methods(find_route)
+        eager = planner.anyhop(state, tasks)
+        eager_copies, copies = copies, 0
+        lazy = planner.anyhop(state, tasks, lazy_successors=True)
+        self.assertEqual([plan_time[:2] for plan_time in eager], [plan_time[:2] for plan_time in lazy])
+        self.assertLess(copies, eager_copies)
+
+    def test_pending_plan_step(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        root = PlanStep([], [('go', 'robot', 'mcrey312', 'lounge')], state, planner.copy_func, planner.cost_func)
+        pending = root.successors(planner, lazy=True)[0]
+        self.assertEqual(1, pending.total_cost)
+        self.assertIsNotNone(pending.parent)
+        self.assertFalse(pending.complete())
+        self.assertIsNone(pending.parent)
+        self.assertEqual([], pending.successors(planner))
+
+    def test_lazy_steps_fail_before_lower_bound(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.lower_bound = hops_to_destination
+        tasks = [('go', 'robot', 'mcrey312', 'lounge'), ('find_route', 'robot', 'lounge', 'copyroom')]
+        self.assertEqual([], [plan for plan in planner.pyhop_generator(state, tasks, max_cost=100,
+                                                                       lazy_successors=True) if plan])
+
+    def test_lazy_steps_with_subplan_cache(self):
+        planner = make_choice_planner(subplan_cache=SubplanCache(['choose']))
+        state = State('state')
+        for i in range(2):
+            self.assertEqual([('succeed',)], planner.anyhop(state, [('choose',)], lazy_successors=True)[-1][0])
+        planner = make_choice_planner(subplan_cache=SubplanCache(['choose']))
+        root = PlanStep([], [('choose',)], state, planner.copy_func, planner.cost_func)
+        pending = [step.successors(planner, lazy=True)[0] for step in root.successors(planner)]
+        self.assertTrue(all(step.parent is not None for step in pending))
+        self.assertEqual(0, len(planner.subplan_cache))
+        self.assertEqual([True, False], [bool(step.state) for step in pending])
+        self.assertEqual(1, len(planner.subplan_cache))
+
+    def test_frontier_cache(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        expected = planner.anyhop(state, tasks, queue_init=lambda: HybridQueue())
+        planner.frontier_cache = MemoCache(max_entries=2)
+        plan_times = planner.anyhop(state, tasks, queue_init=lambda: HybridQueue())
+        self.assertEqual([plan_time[:2] for plan_time in expected], [plan_time[:2] for plan_time in plan_times])
+        self.assertLessEqual(len(planner.frontier_cache), 2)
+        self.assertGreater(planner.frontier_cache.evictions, 0)
+
+    def test_failed_derived_steps(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.lower_bound = hops_to_destination
+        planner.frontier_cache = MemoCache()
+        tasks = [('go', 'robot', 'mcrey312', 'lounge'), ('find_route', 'robot', 'lounge', 'copyroom')]
+        self.assertEqual([], [plan for plan in planner.pyhop_generator(state, tasks, max_cost=100) if plan])
+        planner = make_choice_planner(subplan_cache=SubplanCache(['choose']), frontier_cache=MemoCache())
+        state = State('state')
+        for i in range(2):
+            self.assertEqual([('succeed',)], planner.anyhop(state, [('choose',)])[-1][0])
+
+    def test_derived_plan_step(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.frontier_cache = MemoCache(max_entries=1)
+        step = PlanStep([], tasks, state, planner.copy_func, planner.cost_func)
+        steps = [step]
+        for action in SHORTEST_ROUTE:
+            while step.next_task() != action:
+                step = [option for option in step.successors(planner) if option.next_task() == action][0]
+            step = step.successors(planner)[0]
+            steps.append(step)
+        self.assertTrue(step.complete())
+        planner.frontier_cache = MemoCache(max_entries=1)
+        self.assertEqual({'robot': 'copyroom'}, step.state.loc)
+        self.assertEqual({'robot': 'hallway'}, steps[1].state.loc)
+
+    def test_anyhop_random_parallel(self):
+        state, tasks = make_travel_state()
+        plan_times = make_travel_planner().anyhop_random_parallel(state, tasks, 0.2, num_workers=2, seed=1)
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        for i in range(1, len(plan_times)):
+            self.assertLess(plan_times[i][1], plan_times[i - 1][1])
+            self.assertLessEqual(plan_times[i - 1][2], plan_times[i][2])
+
+    def test_anyhop_parallel(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        serial_cost = planner.anyhop(state, tasks)[-1][1]
+        plan_times = planner.anyhop_parallel(state, tasks, num_workers=3)
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        self.assertEqual(serial_cost, plan_times[-1][1])
+        self.assertGreater(planner.node_expansions, 0)
+
+    def test_parallel_worker_exit_raises(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.crash = lambda: os._exit(3)
+        with self.assertRaises(RuntimeError):
+            run_parallel(planner, [('crash', (), {}), ('anyhop', (state, tasks), {})])
+        planner.operators['go'] = lambda state, *args: os._exit(3)
+        with self.assertRaises(RuntimeError):
+            planner.anyhop_parallel(state, tasks, num_workers=2)
+
+    def test_anyhop_portfolio(self):
+        state, tasks = make_travel_state()
+        plan_times = make_travel_planner().anyhop_portfolio(state, tasks, 0.2, engines=('dfs', 'random', 'trail'))
+        self.assertEqual(SHORTEST_ROUTE, plan_times[-1][0])
+        for plan, cost, elapsed, engine in plan_times:
+            self.assertIn(engine, ('dfs', 'random', 'trail'))
+
+    def test_randhop_plan_is_list(self):
+        random.seed(1)
+        state, tasks = make_travel_state()
+        plan_step = None
+        while plan_step is None:
+            plan_step = make_travel_planner().randhop(state, tasks)
+        self.assertEqual(list, type(plan_step.plan))
+        self.assertEqual(plan_step.depth(), len(plan_step.plan))
+        self.assertEqual(('go', 'robot', 'lounge', 'copyroom'), plan_step.plan[-1])
+
+    def test_linked_plan_shares_prefix(self):
+        parent = LinkedPlan.from_list([('a',), ('b',)])
+        child1 = parent.append(('c',))
+        child2 = parent.append(('d',))
+        self.assertIs(child1.steps.tail, child2.steps.tail)
+        self.assertEqual([('a',), ('b',), ('c',)], child1.to_list())
+        self.assertEqual([('a',), ('b',), ('d',)], child2.to_list())
+        self.assertEqual(2, len(parent))
+
+    def test_task_agenda_shares_remaining_tasks(self):
+        state, tasks = make_travel_state()
+        step = PlanStep([], tasks + [('find_route', 'robot', 'copyroom', 'lounge')], state, None, None)
+        children = step.successors(make_travel_planner())
+        self.assertEqual(2, len(children))
+        self.assertIs(children[0].tasks.tail.tail, children[1].tasks.tail.tail)
+        self.assertEqual([('go', 'robot', 'mcrey312', 'hallway'), ('find_route', 'robot', 'hallway', 'copyroom'),
+                          ('find_route', 'robot', 'copyroom', 'lounge')], children[0].tasks.to_list())
+
+    def test_cons_list_push_all(self):
+        agenda = ConsList.from_list([3, 4])
+        self.assertEqual([1, 2, 3, 4], agenda.push_all([1, 2]).to_list())
+        self.assertEqual(2, len(agenda))
+
+    def test_plan_step_accepts_list(self):
+        state, tasks = make_travel_state()
+        step = PlanStep([('go', 'robot', 'mcrey312', 'hallway')], tasks, state, None, None)
+        self.assertEqual(1, step.depth())
+
+    def test_trace_events(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        planner.tracer = ListTraceSink()
+        plan_times = planner.anyhop(state, tasks)
+        self.assertEqual([cost for (plan, cost, elapsed) in plan_times],
+                         [cost for (event, node, depth, cost, detail) in planner.tracer.of_kind(YIELD)])
+        self.assertEqual({'find_route', 'go'}, {detail for (event, node, depth, cost, detail)
+                                                in planner.tracer.of_kind(EXPAND)})
+        self.assertGreater(len(planner.tracer.of_kind(PRUNE)) + len(planner.tracer.of_kind(FAIL)), 0)
+        nodes = [node for (event, node, depth, cost, detail) in planner.tracer.events]
+        self.assertEqual(sorted(nodes), nodes)
+        self.assertLessEqual(nodes[-1], planner.node_expansions)
+
+    def test_jsonl_trace(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.jsonl')
+            with JsonlTraceSink(path) as sink:
+                planner.tracer = sink
+                plan_times = planner.anyhop_trail(state, tasks)
+            events = read_jsonl_trace(path)
+        self.assertEqual([cost for (plan, cost, elapsed) in plan_times],
+                         [event['cost'] for event in events if event['event'] == YIELD])
+        self.assertTrue(all(set(event) == {'event', 'node', 'depth', 'cost', 'detail'} for event in events))
+
+    def test_profiled(self):
+        state, tasks = make_travel_state()
+        planner = make_travel_planner()
+        operators, copy_func = planner.operators, planner.copy_func
+        plan_times, profile = planner.profiled('anyhop', state, tasks)
+        self.assertEqual([(plan, cost) for (plan, cost, elapsed) in planner.anyhop(state, tasks)],
+                         [(plan, cost) for (plan, cost, elapsed) in plan_times])
+        self.assertIs(operators, planner.operators)
+        self.assertIs(copy_func, planner.copy_func)
+        self.assertIsNone(planner.profile)
+        self.assertEqual({'go', 'find_route'}, set(profile.calls))
+        self.assertEqual(profile.calls['go'], profile.copy_calls)
+        self.assertEqual(sum(profile.depths.values()), profile.calls['go'] + profile.calls['find_route'])
+        self.assertEqual(profile.options['go'], profile.calls['go'] - profile.failures['go'])
+        self.assertGreater(profile.branching_factor('find_route'), 1)
+        self.assertGreater(profile.cost_calls, 0)
+        self.assertIn('find_route', profile.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
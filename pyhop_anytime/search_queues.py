@@ -1,5 +1,7 @@
 import heapq
+from collections import OrderedDict
 from functools import total_ordering
+from typing import *
 
 
 class SearchStack:
@@ -60,22 +62,61 @@ class HybridQueue:
             return heapq.heappop(self.heap)
 
 
+class BestFirstQueue:
+    """
+    Orders plan steps by total_cost + weight * heuristic(step), breaking ties in favor of deeper steps and then of
+    steps enqueued earlier. A heuristic that never overestimates the remaining cost with weight 1 gives A* order;
+    larger weights find plans sooner, at a cost of at most weight times the optimum.
+    """
+    def __init__(self, heuristic=lambda step: 0, weight=1.0):
+        self.heuristic = heuristic
+        self.weight = weight
+        self.heap = []
+        self.count = 0
+
+    def enqueue_all_steps(self, items):
+        for step in items:
+            priority = step.total_cost + self.weight * self.heuristic(step)
+            heapq.heappush(self.heap, (priority, -step.depth(), self.count, step))
+            self.count += 1
+
+    def dequeue_step(self):
+        return heapq.heappop(self.heap)[-1]
+
+    def empty(self):
+        return len(self.heap) == 0
+
+
+def mean_rollout_cost(planner, plan_step, num_samples):
+    """Mean cost of num_samples random completions of plan_step, or None if every one of them fails."""
+    options = [plan for plan in (planner.random_completion(plan_step) for i in range(num_samples)) if plan is not None]
+    if len(options) > 0:
+        costs = [plan.total_cost for plan in options]
+        return sum(costs) / len(costs)
+
+
 class MonteCarloPlannerHeap:
-    def __init__(self, planner, num_samples=10, go_deep_first=True, show_progress=False):
+    """
+    Rates each step by the mean cost of random completions of it. An evaluator, such as a
+    parallel.RolloutEvaluator, may rate all the successors of an expansion at once instead.
+    """
+    def __init__(self, planner, num_samples=10, go_deep_first=True, show_progress=False, evaluator=None):
         self.planner = planner
         self.num_samples = num_samples
         self.plan_step_heap = []
         self.go_deep_first = go_deep_first
         self.preferred = None
         self.show_progress = show_progress
+        self.evaluator = evaluator
 
     def enqueue_all_steps(self, items):
+        if self.evaluator is None:
+            ratings = [mean_rollout_cost(self.planner, plan_step, self.num_samples) for plan_step in items]
+        else:
+            ratings = self.evaluator.ratings(items, self.num_samples)
         rated_steps = []
-        for plan_step in items:
-            options = self.planner.n_random(plan_step.state, plan_step.start_tasks, self.num_samples)
-            if len(options) > 0:
-                costs = [plan.total_cost for plan in options]
-                rating = sum(costs) / len(costs)
+        for plan_step, rating in zip(items, ratings):
+            if rating is not None:
                 heapq.heappush(rated_steps, RatedPlanStep(plan_step, rating))
 
         if self.go_deep_first and len(rated_steps) > 0:
@@ -122,3 +163,102 @@ class RatedPlanStep:
 
     def __eq__(self, other):
         return self.rating == other.rating
+
+
+class TranspositionTable:
+    """
+    Remembers the lowest cost at which each (state, agenda) fingerprint was reached. Holds at most max_entries
+    fingerprints, evicting the least recently used one when full.
+    """
+    def __init__(self, max_entries=1000000):
+        self.max_entries = max_entries
+        self.costs = OrderedDict()
+        self.hits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.costs)
+
+    def __repr__(self):
+        return f"TranspositionTable(entries={len(self)}, hits={self.hits}, evictions={self.evictions})"
+
+    def dominated(self, key, cost) -> bool:
+        """
+        True if key was already reached at cost or lower. Otherwise, records cost for key and returns False.
+        """
+        best = self.costs.get(key)
+        if best is not None:
+            self.costs.move_to_end(key)
+            if best <= cost:
+                self.hits += 1
+                return True
+        self.costs[key] = cost
+        if len(self.costs) > self.max_entries:
+            self.costs.popitem(last=False)
+            self.evictions += 1
+        return False
+
+
+class MemoCache:
+    """
+    Least-recently-used cache of method decompositions and operator outcomes, keyed by the kind of function, the
+    task and the fingerprint of the state it was applied to. Holds at most max_entries results. Only suitable for
+    methods and operators whose results depend on nothing but the state and their arguments.
+    """
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def __repr__(self):
+        return f"MemoCache(entries={len(self)}, hits={self.hits}, misses={self.misses}, evictions={self.evictions})"
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def get(self, key, default=None):
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return self.results[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.results[key] = value
+        self.results.move_to_end(key)
+        if len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+
+class SubplanCache(MemoCache):
+    """
+    Cheapest primitive subplan found for each (task, state fingerprint) pair whose decomposition has completed,
+    stored as (subplan, cost, resulting state, fingerprint of the resulting state or None). Only tasks named in
+    task_names are cached. A cached subplan is offered, as a single step, alongside the usual decompositions of its
+    task from that state. Those decompositions are still searched, so a cheaper subplan found later replaces it.
+    Name only tasks, such as navigation subtasks, whose cheapest subplan is as good as any alternative.
+    """
+    def __init__(self, task_names: Iterable[str], max_entries=100000):
+        super().__init__(max_entries)
+        self.task_names = frozenset(task_names)
+
+    def __repr__(self):
+        return f"SubplanCache(entries={len(self)}, hits={self.hits}, misses={self.misses}, evictions={self.evictions})"
+
+    def caches(self, task) -> bool:
+        return task[0] in self.task_names
+
+    def record(self, key, subplan: List, cost: float, state, state_hash):
+        if not state:
+            return
+        best = self.results.get(key)
+        if best is None or cost < best[1]:
+            self.put(key, (subplan, cost, state, state_hash))
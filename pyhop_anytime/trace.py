@@ -0,0 +1,58 @@
+import json
+from typing import *
+
+# Search events reported to a Planner's tracer.
+EXPAND = 'expand'
+PRUNE = 'prune'
+YIELD = 'yield'
+FAIL = 'fail'
+
+
+class ListTraceSink:
+    """
+    Keeps every event as a (event, node, depth, cost, detail) tuple, where node is the planner's count of node
+    expansions when the event occurred.
+    """
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event: str, node: int, depth: int, cost: float, detail=None):
+        self.events.append((event, node, depth, cost, detail))
+
+    def of_kind(self, event: str) -> List[Tuple]:
+        return [entry for entry in self.events if entry[0] == event]
+
+    def close(self):
+        pass
+
+
+class JsonlTraceSink:
+    """
+    Writes each event as one line of JSON to a file, for offline analysis. Pass a path, which is opened for
+    writing and closed by close(), or an open text file, which is left open. Can be used in a with statement.
+    """
+    def __init__(self, file):
+        self.owned = isinstance(file, str)
+        self.file = open(file, 'w') if self.owned else file
+
+    def emit(self, event: str, node: int, depth: int, cost: float, detail=None):
+        self.file.write(json.dumps({'event': event, 'node': node, 'depth': depth, 'cost': cost, 'detail': detail},
+                                   separators=(',', ':'), default=str))
+        self.file.write('\n')
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+def read_jsonl_trace(path: str) -> List[Dict]:
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
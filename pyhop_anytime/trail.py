@@ -0,0 +1,349 @@
+from typing import *
+
+# Placeholder for "this attribute or key did not exist before the change".
+MISSING = object()
+
+# Kinds of trail entries. Every entry is a tuple (kind, target, key, old, path), where path names the location of
+# the modified container relative to the root state: (attribute, key, key, ...).
+SET_ATTR = 0
+SET_ITEM = 1
+LIST_APPEND = 2
+LIST_RESTORE = 3
+SET_ADD = 4
+SET_DISCARD = 5
+SET_RESTORE = 6
+DICT_RESTORE = 7
+
+
+class Trail:
+    """
+    Undo log for a state that is modified in place. Record entries while operators run, take a mark() before
+    applying an operator, and undo_to() that mark to restore the state when backtracking.
+    """
+    def __init__(self):
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def mark(self) -> int:
+        return len(self.entries)
+
+    def record(self, kind, target, key, old, path):
+        self.entries.append((kind, target, key, old, path))
+
+    def undo_to(self, mark: int):
+        entries = self.entries
+        while len(entries) > mark:
+            kind, target, key, old, path = entries.pop()
+            if kind == SET_ATTR:
+                if old is MISSING:
+                    delattr(target, key)
+                else:
+                    setattr(target, key, old)
+            elif kind == SET_ITEM:
+                if old is MISSING:
+                    del target[key]
+                else:
+                    target[key] = old
+            elif kind == LIST_APPEND:
+                target.pop()
+            elif kind == LIST_RESTORE:
+                target[:] = old
+            elif kind == SET_ADD:
+                target.discard(key)
+            elif kind == SET_DISCARD:
+                target.add(key)
+            elif kind == SET_RESTORE or kind == DICT_RESTORE:
+                target.clear()
+                target.update(old)
+
+
+def unwrap(value):
+    while isinstance(value, TrailView):
+        value = value.target
+    return value
+
+
+def wrap(value, trail: Trail, path: Tuple):
+    value_type = type(value)
+    if value_type is dict or value_type is TrailDict:
+        return TrailDict(value, trail, path)
+    elif value_type is list or value_type is TrailList:
+        return TrailList(value, trail, path)
+    elif value_type is set or value_type is TrailSet:
+        return TrailSet(value, trail, path)
+    else:
+        return value
+
+
+class TrailState:
+    """
+    Recording proxy for a State. Operators use it exactly like the State itself. Attribute assignments and
+    mutations of dict, list and set attributes, including nested ones reached by subscription, are recorded in the
+    Trail before they are applied to the underlying state.
+
+    A TrailState may itself wrap a TrailState, in which case every change is recorded in both trails.
+    """
+    def __init__(self, state, trail: Trail):
+        object.__setattr__(self, 'target', state)
+        object.__setattr__(self, 'trail', trail)
+
+    def __getattr__(self, name):
+        return wrap(getattr(self.target, name), self.trail, (name,))
+
+    def __setattr__(self, name, value):
+        self.trail.record(SET_ATTR, self.target, name, getattr(self.target, name, MISSING), (name,))
+        setattr(self.target, name, unwrap(value))
+
+    def __delattr__(self, name):
+        self.trail.record(SET_ATTR, self.target, name, getattr(self.target, name), (name,))
+        delattr(self.target, name)
+
+    def __repr__(self):
+        return repr(self.target)
+
+
+class TrailView:
+    def __init__(self, target, trail: Trail, path: Tuple):
+        self.target = target
+        self.trail = trail
+        self.path = path
+
+    def __len__(self):
+        return len(self.target)
+
+    def __iter__(self):
+        return iter(self.target)
+
+    def __contains__(self, item):
+        return item in self.target
+
+    def __eq__(self, other):
+        return self.target == unwrap(other)
+
+    def __ne__(self, other):
+        return self.target != unwrap(other)
+
+    def __repr__(self):
+        return repr(self.target)
+
+    def __getattr__(self, name):
+        # Only non-mutating methods get here: every mutating method is overridden to record itself first.
+        if name in ('target', 'trail', 'path'):
+            raise AttributeError(name)
+        return getattr(self.target, name)
+
+    def copy(self):
+        return self.target.copy()
+
+    def record(self, kind, key, old):
+        self.trail.record(kind, self.target, key, old, self.path)
+
+
+def forward(name):
+    return lambda self, *args: getattr(self.target, name)(*(unwrap(arg) for arg in args))
+
+
+def add_forwards(view_type: type, names: List[str]):
+    """Operators are looked up on the type rather than through __getattr__, so each one is forwarded explicitly."""
+    for name in names:
+        setattr(view_type, name, forward(name))
+
+
+class TrailDict(TrailView):
+    def __getitem__(self, key):
+        return wrap(self.target[key], self.trail, self.path + (key,))
+
+    def get(self, key, default=None):
+        if key in self.target:
+            return self[key]
+        return default
+
+    def keys(self):
+        return self.target.keys()
+
+    def values(self):
+        return [self[key] for key in self.target]
+
+    def items(self):
+        return [(key, self[key]) for key in self.target]
+
+    def __setitem__(self, key, value):
+        self.record(SET_ITEM, key, self.target.get(key, MISSING))
+        self.target[key] = unwrap(value)
+
+    def __delitem__(self, key):
+        self.record(SET_ITEM, key, self.target[key])
+        del self.target[key]
+
+    def pop(self, key, *default):
+        if key in self.target:
+            self.record(SET_ITEM, key, self.target[key])
+        return self.target.pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self.target:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def popitem(self):
+        self.record(DICT_RESTORE, None, dict(self.target))
+        return self.target.popitem()
+
+    def clear(self):
+        self.record(DICT_RESTORE, None, dict(self.target))
+        self.target.clear()
+
+    def __ior__(self, other):
+        self.update(unwrap(other))
+        return self
+
+
+class TrailList(TrailView):
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return [self[i] for i in range(*index.indices(len(self.target)))]
+        if index < 0:
+            index += len(self.target)
+        return wrap(self.target[index], self.trail, self.path + (index,))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.target)))
+
+    def __reversed__(self):
+        return (self[i] for i in reversed(range(len(self.target))))
+
+    def index(self, *args):
+        return self.target.index(*args)
+
+    def count(self, item):
+        return self.target.count(item)
+
+    def append(self, item):
+        self.record(LIST_APPEND, None, None)
+        self.target.append(unwrap(item))
+
+    def snapshot(self):
+        self.record(LIST_RESTORE, None, self.target[:])
+
+    def __setitem__(self, index, value):
+        self.snapshot()
+        self.target[index] = unwrap(value)
+
+    def __delitem__(self, index):
+        self.snapshot()
+        del self.target[index]
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, count):
+        self.snapshot()
+        self.target *= count
+        return self
+
+    def __radd__(self, other):
+        return unwrap(other) + self.target
+
+    def extend(self, items):
+        self.snapshot()
+        self.target.extend(unwrap(items))
+
+    def insert(self, index, item):
+        self.snapshot()
+        self.target.insert(index, unwrap(item))
+
+    def pop(self, *index):
+        self.snapshot()
+        return self.target.pop(*index)
+
+    def remove(self, item):
+        self.snapshot()
+        self.target.remove(item)
+
+    def sort(self, **kwargs):
+        self.snapshot()
+        self.target.sort(**kwargs)
+
+    def reverse(self):
+        self.snapshot()
+        self.target.reverse()
+
+    def clear(self):
+        self.snapshot()
+        self.target.clear()
+
+
+class TrailSet(TrailView):
+    def add(self, item):
+        if item not in self.target:
+            self.record(SET_ADD, item, None)
+            self.target.add(item)
+
+    def discard(self, item):
+        if item in self.target:
+            self.record(SET_DISCARD, item, None)
+            self.target.discard(item)
+
+    def remove(self, item):
+        if item not in self.target:
+            raise KeyError(item)
+        self.discard(item)
+
+    def update(self, *others):
+        for other in others:
+            for item in unwrap(other):
+                self.add(item)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def difference_update(self, *others):
+        for other in others:
+            for item in unwrap(other):
+                self.discard(item)
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def pop(self):
+        item = self.target.pop()
+        self.record(SET_DISCARD, item, None)
+        return item
+
+    def clear(self):
+        self.record(SET_RESTORE, None, set(self.target))
+        self.target.clear()
+
+    def snapshot(self):
+        self.record(SET_RESTORE, None, set(self.target))
+
+    def intersection_update(self, *others):
+        self.snapshot()
+        self.target.intersection_update(*(unwrap(other) for other in others))
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def symmetric_difference_update(self, other):
+        self.snapshot()
+        self.target.symmetric_difference_update(unwrap(other))
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+
+add_forwards(TrailDict, ['__or__', '__ror__'])
+add_forwards(TrailList, ['__add__', '__mul__', '__rmul__', '__lt__', '__le__', '__gt__', '__ge__'])
+add_forwards(TrailSet, ['__or__', '__ror__', '__and__', '__rand__', '__sub__', '__rsub__', '__xor__', '__rxor__',
+                        '__lt__', '__le__', '__gt__', '__ge__'])
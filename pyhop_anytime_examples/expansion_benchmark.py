@@ -0,0 +1,46 @@
+import random
+import time
+
+from pyhop_anytime import State
+from pyhop_anytime_examples.blocks_world import make_blocks_planner
+from pyhop_anytime_examples.graph_package_world import make_graph_planner, generate_graph_world
+from pyhop_anytime_examples.tsp import tsp_planner, make_metric_tsp_state
+
+
+def blocks_problem():
+    state = State('state3')
+    state.pos = {1: 12, 12: 13, 13: 'table', 11: 10, 10: 5, 5: 4, 4: 14, 14: 15, 15: 'table', 9: 8, 8: 7, 7: 6,
+                 6: 'table', 19: 18, 18: 17, 17: 16, 16: 3, 3: 2, 2: 'table'}
+    state.clear = {x: False for x in range(1, 20)}
+    state.clear.update({1: True, 11: True, 9: True, 19: True})
+    state.holding = False
+    goal = State('goal3')
+    goal.pos = {15: 13, 13: 8, 8: 9, 9: 4, 4: 'table', 12: 2, 2: 3, 3: 16, 16: 11, 11: 7, 7: 6, 6: 'table'}
+    goal.clear = {17: True, 15: True, 12: True}
+    return state, [('move_blocks', goal)]
+
+
+def problems():
+    random.seed(0)
+    return [('tsp', tsp_planner(), make_metric_tsp_state(9, 100, 100)),
+            ('graph packages', make_graph_planner(),
+             generate_graph_world(100, 100, capacity=3, num_locations=36, edge_prob=0.25, num_packages=12)),
+            ('blocks', make_blocks_planner(), blocks_problem())]
+
+
+def expansions_per_second(planner, search, max_seconds) -> float:
+    start = time.time()
+    search(max_seconds)
+    return planner.node_expansions / (time.time() - start)
+
+
+if __name__ == '__main__':
+    max_seconds = 3
+    print(f"Node expansions per second, {max_seconds}s per run")
+    for name, planner, (state, tasks) in problems():
+        random.seed(1)
+        dfs = expansions_per_second(planner, lambda seconds: planner.anyhop(state, tasks, max_seconds=seconds),
+                                    max_seconds)
+        rollouts = expansions_per_second(planner, lambda seconds: planner.anyhop_random(state, tasks, seconds),
+                                         max_seconds)
+        print(f"{name:>15}: anyhop {dfs:10.0f}\tanyhop_random {rollouts:10.0f}")
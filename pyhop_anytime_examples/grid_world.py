@@ -57,7 +57,7 @@ def generate_grid_world(width, height, start, start_facing, end, num_obstacles):
 
 
 def make_grid_planner():
-    p = Planner()
+    p = Planner(static_attributes={'grid'})
     p.declare_operators(move_one_step, turn_to)
     p.declare_methods(find_route)
     return p
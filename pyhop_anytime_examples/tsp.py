@@ -36,8 +36,15 @@ def complete_tour_from(state, current_city):
     return TaskList(tasks)
 
 
-def tsp_planner():
-    planner = Planner(cost_func=lambda state, step: state.graph.edges[state.at][step[2]])
+def mst_lower_bound(state, tasks):
+    """The rest of the tour links the current city to every unvisited city, so it costs at least their MST."""
+    return state.graph.spanning_tree_cost([city for city in state.graph.all_nodes()
+                                           if city == state.at or city not in state.visited])
+
+
+def tsp_planner(use_mst_bound=False):
+    planner = Planner(cost_func=lambda state, step: state.graph.edges[state.at][step[2]],
+                      static_attributes={'graph'}, lower_bound=mst_lower_bound if use_mst_bound else None)
     planner.declare_operators(move)
     planner.declare_methods(complete_tour_from)
     return planner
@@ -46,7 +46,8 @@ def complete_tour_from(state, current):
 
 
 def tsp_planner():
-    planner = Planner(cost_func=lambda state, step: state.graph.edges[state.at][step[2]])
+    planner = Planner(cost_func=lambda state, step: state.graph.edges[state.at][step[2]],
+                      static_attributes={'graph', 'good_edges'})
     planner.declare_operators(move)
     planner.declare_methods(complete_tour_from)
     return planner